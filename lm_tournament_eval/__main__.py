@@ -7,11 +7,10 @@ import os
 import csv
 
 from lm_tournament_eval import utils
-from lm_tournament_eval.api.tournament import TournamentConfig, Tournament
-from lm_tournament_eval.api.offline_tournament import OfflineTournamentConfig, OfflineTournament
-from lm_tournament_eval.api.task import TaskConfig
 from lm_tournament_eval.tasks import TaskManager
-from lm_tournament_eval.evaluator_utils import request_caching_arg_to_dict
+
+# tournaments (and torch, transformers, datasets, ...) are imported once it is clear
+# which one runs, so that listing tasks and offline tournaments start quickly
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
@@ -22,7 +21,10 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument("--model1_args", type=str, help="Arguments for model 1.")
     parser.add_argument("--tasks", "-t", default=None, type=str, metavar="task1,task2")
     parser.add_argument("--num_rounds", default=1, type=int)
-    parser.add_argument("--batch_size", "-b", default=1, type=int)
+    parser.add_argument("--batch_size", "-b", default="1", type=str,
+                        help="Number of requests per batch, or 'auto' to fill each batch up to a token budget probed from device memory.")
+    parser.add_argument("--max_batch_size", type=int, default=64,
+                        help="Maximal number of requests per batch with --batch_size auto.")
     parser.add_argument("--match_size", default=1, type=int)
     parser.add_argument("--device", type=str, default="cuda:0")
     parser.add_argument("--output_path", "-o", type=str, default=".")
@@ -41,6 +43,35 @@ def setup_parser() -> argparse.ArgumentParser:
                         action="store_true",
                         help="Sets trust_remote_code to True to execute code to create HF Datasets from the Hub")
     parser.add_argument("--limit", type=int)
+    parser.add_argument("--num_proc", type=int, default=None,
+                        help="Number of processes used to build few-shot contexts of each task.")
+    parser.add_argument("--profile_startup",
+                        action="store_true",
+                        help="Print the time spent importing each module when the run exits.")
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="Build, run and score requests in chunks of docs instead of all at once, "
+                             "so memory does not grow with the size of the tasks (single process only).")
+    parser.add_argument("--use_cache", "-c", type=str, default=None, metavar="PREFIX",
+                        help="Cache model responses in SQLite databases at `PREFIX_rank<rank>.db`, one per process. "
+                             "Sampled generations are not cached. `None` if not caching.")
+    parser.add_argument("--assisted_decoding",
+                        action="store_true",
+                        help="Use the quantized (or smaller) competitor as a draft model when generating with the other one.")
+
+    parser.add_argument("--residency", type=str, default="auto", metavar="auto|concurrent|sequential",
+                        help="Keep both models loaded at once, or load, evaluate and free them one at a time. "
+                             "'auto' loads them concurrently only if both fit in free device memory.")
+    parser.add_argument("--serve",
+                        action="store_true",
+                        help="Run a local model server that keeps loaded models in memory, so that later tournaments can reuse them.")
+    parser.add_argument("--server_socket", type=str, default=None, metavar="PATH",
+                        help="Load models through the model server on this Unix socket. With --serve, the socket to listen on, "
+                             "which defaults to a per-user socket in $XDG_RUNTIME_DIR or the temp directory.")
+    parser.add_argument("--server_memory_gb", type=float, default=None,
+                        help="With --serve, evict idle models when loaded models exceed this many GiB.")
+    parser.add_argument("--server_idle_timeout", type=float, default=3600,
+                        help="With --serve, evict models that have not been used for this many seconds.")
 
     parser.add_argument("--offline", type=bool, default=False, 
                         help="If True, run offline analysis of two output files from lm-evaluation-harness.")
@@ -59,13 +90,107 @@ def setup_parser() -> argparse.ArgumentParser:
     return parser
 
 
+def setup_cache_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="lm-tournament-eval cache")
+    parser.add_argument("--cache_path", type=str, default=None, metavar="DIR",
+                        help="Cache directory. Defaults to $LM_HARNESS_CACHE_PATH or ~/.cache/lm_tournament_eval.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    inspect_parser = subparsers.add_parser("inspect", help="List cache entries, least recently used first.")
+    inspect_parser.add_argument("--prefix", type=str, default="", help="Only list keys starting with this prefix.")
+
+    prune_parser = subparsers.add_parser("prune", help="Delete cache entries.")
+    prune_parser.add_argument("--prefix", type=str, default="", help="Only delete keys starting with this prefix.")
+    prune_parser.add_argument("--max_bytes", type=int, default=None,
+                              help="Delete least recently used entries until the cache holds at most this many bytes.")
+    prune_parser.add_argument("--older_than_days", type=float, default=None,
+                              help="Delete entries not used for this many days.")
+    prune_parser.add_argument("--all", action="store_true", help="Delete all (matching) entries.")
+
+    return parser
+
+
+def run_cache_command(argv) -> None:
+    from lm_tournament_eval.caching.cache import PATH, CacheStore
+
+    args = setup_cache_parser().parse_args(argv)
+    store = CacheStore(args.cache_path or PATH, max_bytes=None)
+
+    if args.command == "inspect":
+        entries = store.entries(args.prefix)
+        for key, size, last_access in entries:
+            last_used = datetime.datetime.fromtimestamp(last_access).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{size:>12}  {last_used}  {key}")
+        print(f"{len(entries)} entries, {sum(size for _, size, _ in entries)} bytes in {store.root}")
+    elif args.command == "prune":
+        older_than = -1 if args.all else (
+            args.older_than_days * 86400 if args.older_than_days is not None else None
+        )
+        deleted = store.prune(max_bytes=args.max_bytes, older_than=older_than, prefix=args.prefix)
+        print(f"Deleted {len(deleted)} entries from {store.root}")
+
+
+def profile_imports() -> None:
+    """Times the import of every module imported from now on and prints the slowest at exit."""
+    import atexit
+    import builtins
+    import time
+
+    original_import = builtins.__import__
+    # module -> (cumulative seconds, seconds excluding nested imports)
+    timings = {}
+    nested = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        nested.append(0.0)
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            timings[name] = (elapsed, elapsed - nested.pop())
+            if nested:
+                nested[-1] += elapsed
+
+    def report() -> None:
+        print(f"{'cumulative':>10} {'self':>8}  module (seconds)", file=sys.stderr)
+        for name, (cumulative, own) in sorted(timings.items(), key=lambda x: -x[1][0])[:40]:
+            print(f"{cumulative:10.3f} {own:8.3f}  {name}", file=sys.stderr)
+
+    builtins.__import__ = timed_import
+    atexit.register(report)
+
+
 def run_tournament():
     # print("Running tournament!")
 
+    if "--profile_startup" in sys.argv:
+        profile_imports()
+
+    # `lm-tournament-eval cache inspect|prune` manages the request cache
+    if sys.argv[1:2] == ["cache"]:
+        run_cache_command(sys.argv[2:])
+        return
+
     # handle arguments.
     parser = setup_parser()
     args = parser.parse_args()
 
+    if args.batch_size != "auto":
+        args.batch_size = int(args.batch_size)
+
+    if args.serve:
+        from lm_tournament_eval.models.model_server import ModelServer
+
+        ModelServer(
+            args.server_socket,
+            memory_budget_gb=args.server_memory_gb,
+            idle_timeout=args.server_idle_timeout,
+        ).serve_forever()
+        sys.exit()
+
     if args.include_path is not None:
         logging.info(f"Including path: {args.include_path}")
     task_manager = TaskManager(args.verbosity, include_path=args.include_path)
@@ -152,6 +277,9 @@ def run_tournament():
     logging.info(f"Using initial elo scores {initial_elos}")
 
     if args.offline == True:
+        from lm_tournament_eval.api.offline_tournament import OfflineTournamentConfig, OfflineTournament
+        from lm_tournament_eval.api.task import TaskConfig
+
         # validate tournament parameters.
         task_config = TaskConfig()
         cfg = OfflineTournamentConfig(name=args.tournament_name,
@@ -170,6 +298,8 @@ def run_tournament():
         # run tournament evaluator.
         result = tournament.run_tournament()    
     else:
+        from lm_tournament_eval.api.tournament import TournamentConfig, Tournament
+
         # validate tournament parameters.
         cfg = TournamentConfig(name=args.tournament_name,
                               rounds=args.num_rounds,
@@ -179,9 +309,16 @@ def run_tournament():
                               model1_args=args.model1_args,
                               task_names=task_names,
                               batch_size=args.batch_size,
+                              max_batch_size=args.max_batch_size,
                               device=args.device,
                               limit=args.limit,
-                              match_size=args.match_size
+                              match_size=args.match_size,
+                              assisted_decoding=args.assisted_decoding,
+                              use_cache=args.use_cache,
+                              server_socket=args.server_socket,
+                              residency=args.residency,
+                              num_proc=args.num_proc,
+                              streaming=args.streaming
                              )
 
         #create tournament
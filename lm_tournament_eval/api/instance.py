@@ -2,33 +2,190 @@
 Taken from: https://github.com/EleutherAI/lm-evaluation-harness/blob/main/lm_eval/api/instance.py
 '''
 
-from dataclasses import dataclass, field
-from typing import Literal, Optional, Tuple
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, List, Literal, Mapping, Optional, Tuple
 
 OutputType = Literal[
     "loglikelihood", "loglikelihood_rolling", "generate_until", "multiple_choice"
 ]
 
-@dataclass
+# marks a filter that has not been applied to an Instance yet
+_MISSING = object()
+
+
+class ResponseTable:
+    '''
+    Responses of all Instances of a task, stored in lists preallocated for every
+    Instance and indexed by its position in the task, with one list per filter
+    instead of a `filtered_resps` dict per Instance. See `Instance.use_response_table`.
+    '''
+
+    __slots__ = ("resps", "filtered_resps")
+
+    def __init__(self, size: int) -> None:
+        # the responses of an Instance are a list of its repeats, created on first use
+        self.resps: List[Optional[list]] = [None] * size
+        self.filtered_resps: Dict[str, list] = {}
+
+    def filtered_column(self, name: str) -> list:
+        column = self.filtered_resps.get(name)
+        if column is None:
+            column = self.filtered_resps[name] = [_MISSING] * len(self.resps)
+        return column
+
+
+class _FilteredResps(MutableMapping):
+    '''The filtered responses of one Instance, stored in a `ResponseTable`.'''
+
+    __slots__ = ("_table", "_pos")
+
+    def __init__(self, table: ResponseTable, pos: int) -> None:
+        self._table = table
+        self._pos = pos
+
+    def __getitem__(self, name: str):
+        column = self._table.filtered_resps.get(name)
+        if column is None or column[self._pos] is _MISSING:
+            raise KeyError(name)
+        return column[self._pos]
+
+    def __setitem__(self, name: str, value) -> None:
+        self._table.filtered_column(name)[self._pos] = value
+
+    def __delitem__(self, name: str) -> None:
+        column = self._table.filtered_resps.get(name)
+        if column is None or column[self._pos] is _MISSING:
+            raise KeyError(name)
+        column[self._pos] = _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        return (
+            name
+            for name, column in self._table.filtered_resps.items()
+            if column[self._pos] is not _MISSING
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
 class Instance:
-    request_type: OutputType
-    doc: dict
-    arguments: tuple
-    idx: int
-    metadata: Tuple[Optional[str], Optional[int], Optional[int]] = field(
-        default_factory=lambda: (None, None, None)
-    )
-    resps: list = field(default_factory=list)
-    filtered_resps: dict = field(default_factory=dict)
+    '''
+    A single request to a model and its responses.
 
-    # initialized after init
-    task_name: Optional[str] = None
-    doc_id: Optional[int] = None
-    repeats: Optional[int] = None
+    Tasks create one Instance per request (e.g. per choice of a multiple choice
+    doc), so Instances are kept small: attributes live in `__slots__`, the doc can
+    be looked up by `doc_id` in a doc table shared by all Instances of a task (see
+    `use_doc_table`), and responses can be kept in a `ResponseTable` shared by all
+    Instances of a task (see `use_response_table`). Instances without a table
+    only allocate `resps`/`filtered_resps` once used.
+    '''
 
-    def __post_init__(self) -> None:
+    __slots__ = (
+        "request_type",
+        "arguments",
+        "idx",
+        "task_name",
+        "doc_id",
+        "repeats",
+        "_doc",
+        "_docs",
+        "_resps",
+        "_filtered_resps",
+        "_table",
+        "_pos",
+    )
+
+    def __init__(
+        self,
+        request_type: OutputType,
+        doc: Optional[dict],
+        arguments: tuple,
+        idx: int,
+        metadata: Tuple[Optional[str], Optional[int], Optional[int]] = (None, None, None),
+        resps: Optional[list] = None,
+        filtered_resps: Optional[dict] = None,
+    ) -> None:
+        self.request_type = request_type
+        self.arguments = arguments
+        self.idx = idx
         # unpack metadata field
-        self.task_name, self.doc_id, self.repeats = self.metadata
+        self.task_name, self.doc_id, self.repeats = metadata
+        self._doc = doc
+        self._docs = None
+        self._resps = resps
+        self._filtered_resps = filtered_resps
+        self._table = None
+        self._pos = None
+
+    @property
+    def metadata(self) -> Tuple[Optional[str], Optional[int], Optional[int]]:
+        return (self.task_name, self.doc_id, self.repeats)
+
+    @property
+    def doc(self) -> Optional[dict]:
+        if self._docs is not None:
+            return self._docs[self.doc_id]
+        return self._doc
+
+    @doc.setter
+    def doc(self, doc: Optional[dict]) -> None:
+        self._doc = doc
+        self._docs = None
+
+    def use_doc_table(self, docs: Mapping[int, dict]) -> None:
+        '''
+        Looks the doc up in `docs` by `doc_id` instead of holding it, so that
+        pickling the Instances of a task stores each doc only once with the table.
+        '''
+        self._docs = docs
+        self._doc = None
+
+    def use_response_table(self, table: ResponseTable, pos: int) -> None:
+        '''
+        Stores the responses of this Instance at `pos` in `table`, starting out
+        without responses (e.g. for a copy of an Instance evaluated by another model).
+        '''
+        self._table, self._pos = table, pos
+        self._resps = self._filtered_resps = None
+
+    @property
+    def resps(self) -> list:
+        if self._table is not None:
+            resps = self._table.resps[self._pos]
+            if resps is None:
+                resps = self._table.resps[self._pos] = []
+            return resps
+        if self._resps is None:
+            self._resps = []
+        return self._resps
+
+    @resps.setter
+    def resps(self, resps: list) -> None:
+        if self._table is not None:
+            self._table.resps[self._pos] = resps
+        else:
+            self._resps = resps
+
+    @property
+    def filtered_resps(self) -> MutableMapping:
+        if self._table is not None:
+            return _FilteredResps(self._table, self._pos)
+        if self._filtered_resps is None:
+            self._filtered_resps = {}
+        return self._filtered_resps
+
+    @filtered_resps.setter
+    def filtered_resps(self, filtered_resps: dict) -> None:
+        if self._table is not None:
+            view = _FilteredResps(self._table, self._pos)
+            view.clear()
+            view.update(filtered_resps)
+        else:
+            self._filtered_resps = filtered_resps
 
     @property
     def args(self):
@@ -37,4 +194,18 @@ class Instance:
         """
         return (
             self.arguments if isinstance(self.arguments, tuple) else (self.arguments,)
-        )    
\ No newline at end of file
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Instance(request_type={self.request_type!r}, doc_id={self.doc_id!r}, "
+            f"idx={self.idx!r}, arguments={self.arguments!r})"
+        )
+
+
+def use_response_table(instances: List[Instance]) -> ResponseTable:
+    '''Stores the responses of `instances` in a new `ResponseTable` shared by all of them.'''
+    table = ResponseTable(len(instances))
+    for pos, instance in enumerate(instances):
+        instance.use_response_table(table, pos)
+    return table
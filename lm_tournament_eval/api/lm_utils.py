@@ -18,6 +18,11 @@ from typing import (
 
 import torch
 import collections
+import hashlib
+import heapq
+import json
+import queue
+import threading
 
 import transformers
 
@@ -32,6 +37,169 @@ def get_batches(in_arr: List, n: int = 1):
     if arr:
         yield arr
 
+class BatchPrefetcher:
+    """
+    Iterates over `prepare_fn(batch)` for every batch in `batches`, preparing up to
+    `depth` batches ahead on a background thread so host-side work overlaps with
+    whatever the consumer is doing. With `depth=0` batches are prepared inline.
+    """
+
+    _END = object()
+
+    def __init__(self, batches: Iterable, prepare_fn: Callable, depth: int = 2) -> None:
+        self.batches = batches
+        self.prepare_fn = prepare_fn
+        self.depth = depth
+
+    def __iter__(self) -> Iterator:
+        if self.depth <= 0:
+            for batch in self.batches:
+                yield self.prepare_fn(batch)
+            return
+
+        prepared = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker() -> None:
+            try:
+                for batch in self.batches:
+                    if not put(self.prepare_fn(batch)):
+                        return
+            except BaseException as err:
+                put(err)
+            put(self._END)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = prepared.get()
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+def longest_common_prefix(seqs: List[List[int]]) -> List[int]:
+    """
+    Longest common prefix of a list of token sequences. As in a trie over the
+    sorted sequences, it is the common prefix of the smallest and largest ones.
+    """
+    if not seqs:
+        return []
+    first, last = min(seqs), max(seqs)
+    n = 0
+    for a, b in zip(first, last):
+        if a != b:
+            break
+        n += 1
+    return first[:n]
+
+class PrefixKVCache:
+    """
+    LRU cache of past key/values for token prefixes, bounded by the memory its
+    tensors take up. Values are legacy `((key, value), ...)` tuples with a batch
+    dimension of 1.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    @staticmethod
+    def size_of(past_key_values) -> int:
+        return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+    def lookup(self, tokens: Tuple[int, ...]):
+        """Returns the longest cached prefix of `tokens` and its past key/values, or (None, None)."""
+        best = None
+        for key in self.entries:
+            if len(key) <= len(tokens) and (best is None or len(key) > len(best)):
+                if tokens[: len(key)] == key:
+                    best = key
+        if best is None:
+            return None, None
+        self.entries.move_to_end(best)
+        return best, self.entries[best]
+
+    def insert(self, tokens: Tuple[int, ...], past_key_values) -> None:
+        size = self.size_of(past_key_values)
+        if size > self.max_bytes:
+            return
+        if tokens in self.entries:
+            self.nbytes -= self.size_of(self.entries.pop(tokens))
+        while self.entries and self.nbytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.size_of(evicted)
+        self.entries[tokens] = past_key_values
+        self.nbytes += size
+
+def get_batches_by_token_budget(
+    lengths: List[int], max_tokens: int, max_batch_size: Optional[int] = None
+):
+    """
+    Groups request indices into batches whose padded size (batch size times the
+    longest sequence in the batch) stays within `max_tokens`. Requests are taken
+    longest first so that each batch holds sequences of similar length. A single
+    request longer than the budget still gets a batch of its own.
+
+    Yields lists of indices into `lengths`.
+    """
+    arr = []
+    padded_len = 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        padded_len = max(padded_len, lengths[i])
+        if arr and (
+            (len(arr) + 1) * padded_len > max_tokens
+            or (max_batch_size is not None and len(arr) == max_batch_size)
+        ):
+            yield arr
+            arr = []
+            padded_len = lengths[i]
+        arr.append(i)
+
+    if arr:
+        yield arr
+
+def tokenizers_match(tokenizer_a, tokenizer_b) -> bool:
+    """
+    Returns True if two tokenizers map text to the same token ids, so that one
+    model can be used as a draft model for another.
+    """
+    if tokenizer_a is tokenizer_b:
+        return True
+    if len(tokenizer_a) != len(tokenizer_b):
+        return False
+    return tokenizer_a.get_vocab() == tokenizer_b.get_vocab()
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Returns a hash that identifies how `tokenizer` maps text to token ids, e.g. to
+    key caches of token ids.
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # fast tokenizers serialize their full pipeline (normalizer, model, added tokens)
+        data = backend.to_str()
+    else:
+        data = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(
+        f"{type(tokenizer).__name__}|{len(tokenizer)}|{data}".encode("utf-8")
+    ).hexdigest()
+
 def configure_pad_token(tokenizer):
     if tokenizer.pad_token is not None:
         pass
@@ -206,3 +374,66 @@ def pad_and_concat(
 
     return torch.cat(tensors, dim=0)
 
+def pack_sequences(lengths: List[int], row_length: int) -> List[List[int]]:
+    """
+    Packs sequences into rows of at most `row_length` tokens, placing the longest
+    sequences first into the row with the most room left. Returns the indices of
+    the sequences in each row, in packing order.
+    """
+    assert all(
+        length <= row_length for length in lengths
+    ), f"Cannot pack a sequence longer than the row length {row_length}"
+
+    rows = []
+    # max-heap of (-remaining capacity, row index)
+    open_rows = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if open_rows and -open_rows[0][0] >= lengths[i]:
+            remaining, row = heapq.heappop(open_rows)
+            remaining += lengths[i]
+        else:
+            row = len(rows)
+            rows.append([])
+            remaining = lengths[i] - row_length
+        rows[row].append(i)
+        if remaining < 0:
+            heapq.heappush(open_rows, (remaining, row))
+
+    return rows
+
+def make_packed_attention_mask(
+    segment_lengths: List[List[int]],
+    row_length: int,
+    dtype: torch.dtype,
+    device=None,
+) -> torch.Tensor:
+    """
+    Builds an additive, block-diagonal causal attention mask of shape
+    [rows, 1, row_length, row_length] for packed rows, so that tokens only attend
+    to earlier tokens of their own segment. Trailing padding in a row is treated
+    as its own segment to keep every query row attending to something.
+    """
+    causal = torch.tril(torch.ones(row_length, row_length, dtype=torch.bool, device=device))
+    mask = torch.zeros(len(segment_lengths), 1, row_length, row_length, dtype=torch.bool, device=device)
+    for row, lengths in enumerate(segment_lengths):
+        offset = 0
+        for length in list(lengths) + [row_length - sum(lengths)]:
+            mask[row, 0, offset : offset + length, offset : offset + length] = True
+            offset += length
+    mask &= causal
+
+    additive = torch.zeros(mask.shape, dtype=dtype, device=device)
+    additive.masked_fill_(~mask, torch.finfo(dtype).min)
+    return additive
+
+def make_packed_position_ids(
+    segment_lengths: List[List[int]], row_length: int, device=None
+) -> torch.Tensor:
+    """Position ids that restart at 0 for every segment of a packed row."""
+    position_ids = torch.zeros(len(segment_lengths), row_length, dtype=torch.long, device=device)
+    for row, lengths in enumerate(segment_lengths):
+        offset = 0
+        for length in lengths:
+            position_ids[row, offset : offset + length] = torch.arange(length, device=device)
+            offset += length
+    return position_ids
@@ -7,8 +7,6 @@ from collections.abc import Iterable
 from typing import List
 
 import numpy as np
-import sacrebleu
-import sklearn.metrics
 
 from lm_tournament_eval.api.registry import register_aggregation, register_metric
 
@@ -51,6 +49,8 @@ def bits_per_byte(items):
 
 @register_aggregation("f1")
 def f1_score(items):
+    import sklearn.metrics
+
     unzipped_list = list(zip(*items))
     golds = unzipped_list[0]
     preds = unzipped_list[1]
@@ -61,6 +61,8 @@ def f1_score(items):
 
 @register_aggregation("matthews_corrcoef")
 def matthews_corrcoef(items):
+    import sklearn.metrics
+
     unzipped_list = list(zip(*items))
     golds = unzipped_list[0]
     preds = unzipped_list[1]
@@ -83,6 +85,8 @@ def bleu(items):
     refs = list(zip(*items))[0]
     preds = list(zip(*items))[1]
     refs, preds = _sacreformat(refs, preds)
+    import sacrebleu
+
     return sacrebleu.corpus_bleu(preds, refs).score
 
 
@@ -98,6 +102,8 @@ def chrf(items):
     refs = list(zip(*items))[0]
     preds = list(zip(*items))[1]
     refs, preds = _sacreformat(refs, preds)
+    import sacrebleu
+
     return sacrebleu.corpus_chrf(preds, refs).score
 
 
@@ -114,6 +120,8 @@ def ter(items):
     refs = list(zip(*items))[0]
     preds = list(zip(*items))[1]
     refs, preds = _sacreformat(refs, preds)
+    import sacrebleu
+
     return sacrebleu.corpus_ter(preds, refs).score
 
 
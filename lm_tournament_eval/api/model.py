@@ -1,4 +1,9 @@
 import abc
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
 
 from typing import Dict, List, Optional, Tuple, Type, TypeVar
 
@@ -26,6 +31,10 @@ class LM(abc.ABC):
     def generate_until(self, requests) -> List[str]:
         pass
 
+    def close(self) -> None:
+        """Releases resources besides the model weights, e.g. worker processes or connections."""
+        pass
+
     @property
     def rank(self):
         return self._rank
@@ -51,4 +60,102 @@ class LM(abc.ABC):
         additional_config = {
             k: v for k, v in additional_config.items() if v is not None
         }
-        return cls(**arg_dict, **additional_config)
\ No newline at end of file
+        return cls(**arg_dict, **additional_config)
+
+
+def is_deterministic(reqtype: str, args) -> bool:
+    """Whether the model always returns the same response to a request."""
+    if reqtype != "generate_until":
+        return True
+    gen_kwargs = args[1] if len(args) > 1 and isinstance(args[1], dict) else {}
+    do_sample = gen_kwargs.get("do_sample", None)
+    # HFLM decodes greedily unless sampling is requested or a temperature is set
+    return do_sample is False or (not do_sample and gen_kwargs.get("temperature", 0.0) == 0.0)
+
+
+def hash_args(fingerprint: str, attr: str, args) -> str:
+    dat = json.dumps([fingerprint, attr] + list(args), default=str)
+    return hashlib.sha256(dat.encode("utf-8")).hexdigest()
+
+
+class CachingLM:
+    """
+    Wraps an LM and stores its responses in an SQLite database, so that reruns
+    only send requests that have not been seen before to the model.
+
+    Keys are built from `fingerprint` (which should identify the model, e.g. its
+    name and model_args including quantization), the request type and the request
+    arguments. All other attributes are forwarded to the wrapped LM.
+    """
+
+    # number of keys per `SELECT ... IN (...)` lookup, below SQLite's variable limit
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, lm: LM, cache_db: str, fingerprint: str) -> None:
+        self.lm = lm
+        self.cache_db = cache_db
+        self.fingerprint = fingerprint
+        if os.path.dirname(cache_db):
+            os.makedirs(os.path.dirname(cache_db), exist_ok=True)
+        self.dbdict = sqlite3.connect(cache_db)
+        with self.dbdict:
+            self.dbdict.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB)"
+            )
+
+    def __getattr__(self, attr: str):
+        lm_attr = getattr(self.lm, attr)
+        if attr not in ["loglikelihood", "loglikelihood_rolling", "generate_until"]:
+            return lm_attr
+
+        def fn(requests):
+            keys = [
+                # sampled generations should not be replayed from the cache
+                hash_args(self.fingerprint, attr, req.args) if is_deterministic(attr, req.args) else None
+                for req in requests
+            ]
+            cached = self._lookup([key for key in keys if key is not None])
+
+            res = [cached.get(key) if key is not None else None for key in keys]
+            remaining_reqs = [
+                req for req, key in zip(requests, keys) if key not in cached
+            ]
+            logging.info(
+                f"Cached requests: {len(requests) - len(remaining_reqs)}, Requests remaining: {len(remaining_reqs)}"
+            )
+
+            # actually run the LM on the requests that do not have cached results
+            rem_res = getattr(self.lm, attr)(remaining_reqs) if remaining_reqs else []
+
+            # stick the new ones back into the list and write them back in one transaction
+            new_rows = []
+            rem_iter = iter(rem_res)
+            for i, key in enumerate(keys):
+                if key is not None and key in cached:
+                    continue
+                res[i] = next(rem_iter)
+                if key is not None:
+                    new_rows.append((key, pickle.dumps(res[i])))
+
+            with self.dbdict:
+                self.dbdict.executemany(
+                    "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                    new_rows,
+                )
+
+            return res
+
+        return fn
+
+    def _lookup(self, keys: List[str]) -> Dict:
+        cached = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), self.LOOKUP_CHUNK_SIZE):
+            chunk = unique_keys[i : i + self.LOOKUP_CHUNK_SIZE]
+            rows = self.dbdict.execute(
+                f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, value in rows:
+                cached[key] = pickle.loads(value)
+        return cached
@@ -1,10 +1,43 @@
+import glob
+import json
 import logging
+import os
+import threading
 import lm_tournament_eval.models
 from lm_tournament_eval.api.registry import get_model
 from lm_tournament_eval.utils import simple_parse_args_string
+from typing import List, Optional, Union
 
-def load_model(model_type, model, model_args, batch_size: int = 1,
-               max_batch_size: int = 1, device: str = "cuda:0"):
+def load_model(model_type, model, model_args, batch_size: Union[int, str] = 1,
+               max_batch_size: int = 1, device: str = "cuda:0",
+               server_socket: Optional[str] = None, use_server: bool = False):
+
+    # with use_server, use a running model server so the weights are loaded only once
+    # across tournaments. Distributed runs always load their own copy.
+    if use_server and isinstance(model, str) and int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        from lm_tournament_eval.models.model_server import (
+            RemoteLM,
+            connect_to_server,
+            default_socket_path,
+        )
+
+        server_socket = server_socket or default_socket_path()
+        conn = connect_to_server(server_socket)
+        if conn is not None:
+            logging.info(f"Using model server for {model}")
+            return RemoteLM(
+                conn,
+                model_type,
+                model,
+                model_args,
+                {
+                    "batch_size": batch_size,
+                    "max_batch_size": max_batch_size,
+                    "device": device,
+                },
+            )
+        else:
+            logging.warning(f"No model server running on {server_socket}, loading {model} locally.")
 
     # load model0 to device
     if isinstance(model, str):
@@ -48,4 +81,160 @@ def load_model(model_type, model, model_args, batch_size: int = 1,
         logging.info("Using pre-initialized model")
         lm = model
 
-    return lm
\ No newline at end of file
+    return lm
+
+def get_model_files(model: str, model_args=None, download: bool = False) -> List[str]:
+    '''
+    Returns the local paths of a model's safetensors weight files, or an empty list
+    if they cannot be found (and `download` is False).
+    '''
+    if not isinstance(model, str):
+        return []
+    if os.path.isdir(model):
+        return sorted(glob.glob(os.path.join(model, "*.safetensors")))
+
+    if isinstance(model_args, str):
+        model_args = simple_parse_args_string(model_args)
+    revision = (model_args or {}).get("revision", "main")
+    try:
+        from huggingface_hub import snapshot_download
+
+        path = snapshot_download(
+            model,
+            revision=revision,
+            allow_patterns=["*.safetensors", "*.json"],
+            local_files_only=not download,
+        )
+    except Exception as e:
+        logging.debug(f"Could not locate weights of {model}: {e}")
+        return []
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+
+
+# bytes per parameter of the dtypes models are commonly loaded in
+DTYPE_BYTES = {"float32": 4, "float": 4, "float16": 2, "half": 2, "bfloat16": 2}
+
+
+def _config_value(config: dict, *names):
+    for name in names:
+        if config.get(name):
+            return config[name]
+    return None
+
+
+def load_model_config(model: str, model_args=None) -> Optional[dict]:
+    '''
+    Returns a model's config.json as a dict, downloading it if necessary, or None.
+    The config is read as plain JSON, so no remote code is run.
+    '''
+    if not isinstance(model, str):
+        return None
+    if isinstance(model_args, str):
+        model_args = simple_parse_args_string(model_args)
+    try:
+        if os.path.isdir(model):
+            path = os.path.join(model, "config.json")
+        else:
+            from huggingface_hub import hf_hub_download
+
+            path = hf_hub_download(
+                model, "config.json", revision=(model_args or {}).get("revision", "main")
+            )
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        logging.debug(f"Could not load the config of {model}: {e}")
+        return None
+
+
+def estimate_num_parameters(config: dict) -> Optional[int]:
+    '''
+    Estimates the parameter count of a decoder-only transformer from its config,
+    assuming gated MLPs, so it rather overestimates. Returns None if the config
+    lacks the sizes needed.
+    '''
+    # multimodal models keep the language model's sizes in a text config
+    config = {**config, **config.get("text_config", {})}
+    hidden = _config_value(config, "hidden_size", "n_embd", "d_model")
+    layers = _config_value(config, "num_hidden_layers", "n_layer", "num_layers")
+    vocab = _config_value(config, "vocab_size")
+    if not (hidden and layers and vocab):
+        return None
+    heads = _config_value(config, "num_attention_heads", "n_head") or 1
+    head_dim = _config_value(config, "head_dim") or hidden // heads
+    kv_heads = _config_value(config, "num_key_value_heads") or heads
+    intermediate = _config_value(config, "intermediate_size", "n_inner", "ffn_dim") or 4 * hidden
+    experts = _config_value(config, "num_local_experts", "num_experts") or 1
+
+    attention = 2 * hidden * heads * head_dim + 2 * hidden * kv_heads * head_dim
+    mlp = 3 * hidden * intermediate * experts
+    embeddings = vocab * hidden * (1 if config.get("tie_word_embeddings") else 2)
+    return layers * (attention + mlp) + embeddings
+
+
+def estimate_model_bytes(model: str, model_args=None) -> Optional[int]:
+    '''
+    Estimates the memory needed by a model's weights, from its safetensors files if
+    they are local and otherwise from the parameter count and dtype in its config,
+    scaled down for 4/8 bit quantization. Returns None if neither is available.
+    '''
+    files = get_model_files(model, model_args)
+    if files:
+        nbytes = sum(os.path.getsize(f) for f in files)
+    else:
+        config = load_model_config(model, model_args)
+        num_parameters = estimate_num_parameters(config) if config else None
+        if num_parameters is None:
+            return None
+        parsed_args = (
+            simple_parse_args_string(model_args) if isinstance(model_args, str) else dict(model_args or {})
+        )
+        dtype = parsed_args.get("dtype")
+        if dtype in (None, "auto"):
+            dtype = config.get("torch_dtype") or config.get("dtype")
+        nbytes = num_parameters * DTYPE_BYTES.get(str(dtype).replace("torch.", ""), 4)
+    args = model_args if isinstance(model_args, str) else str(model_args or "")
+    if "load_in_4bit" in args:
+        return nbytes // 4
+    if "load_in_8bit" in args:
+        return nbytes // 2
+    return nbytes
+
+
+def available_host_memory() -> Optional[int]:
+    '''Returns the bytes of host memory available to new allocations, or None.'''
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def prefetch_model_files(model: str, model_args=None) -> threading.Thread:
+    '''
+    Reads (and downloads, if necessary) a model's weight files on a background
+    thread, so that they are in the page cache by the time the model is loaded.
+    '''
+
+    def prefetch():
+        try:
+            for path in get_model_files(model, model_args, download=True):
+                with open(path, "rb", buffering=0) as f:
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    while f.read(64 * 2**20):
+                        pass
+        except OSError as e:
+            logging.warning(f"Prefetching weights of {model} failed: {e}")
+            return
+        logging.info(f"Prefetched weights of {model}")
+
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    return thread
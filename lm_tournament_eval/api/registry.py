@@ -1,12 +1,12 @@
+import importlib
 import logging
 from typing import Callable, Dict
 
-import evaluate as hf_evaluate
-
 from lm_tournament_eval.api.model import LM
 
 eval_logger = logging.getLogger("lm-eval")
 
+# model name -> LM class, or "module:Class" for models whose module is not imported yet
 MODEL_REGISTRY = {}
 
 
@@ -20,8 +20,10 @@ def register_model(*names):
                 cls, LM
             ), f"Model '{name}' ({cls.__name__}) must extend LM class"
 
+            # a lazily registered model is replaced by its class once its module is imported
             assert (
                 name not in MODEL_REGISTRY
+                or MODEL_REGISTRY[name] == f"{cls.__module__}:{cls.__name__}"
             ), f"Model named '{name}' conflicts with existing model! Please register with a non-conflicting alias instead."
 
             MODEL_REGISTRY[name] = cls
@@ -30,13 +32,30 @@ def register_model(*names):
     return decorate
 
 
+def register_lazy_model(target: str, *names) -> None:
+    """
+    Registers the LM class `target` ("module:Class") under `names` without importing
+    its module, so that backends and their dependencies are only imported when used.
+    """
+    for name in names:
+        assert (
+            name not in MODEL_REGISTRY
+        ), f"Model named '{name}' conflicts with existing model! Please register with a non-conflicting alias instead."
+        MODEL_REGISTRY[name] = target
+
+
 def get_model(model_name):
     try:
-        return MODEL_REGISTRY[model_name]
+        model = MODEL_REGISTRY[model_name]
     except KeyError:
         raise ValueError(
             f"Attempted to load model '{model_name}', but no model for this name found! Supported model names: {', '.join(MODEL_REGISTRY.keys())}"
         )
+    if isinstance(model, str):
+        module_name, class_name = model.split(":")
+        model = getattr(importlib.import_module(module_name), class_name)
+        MODEL_REGISTRY[model_name] = model
+    return model
 
 
 TASK_REGISTRY = {}
@@ -129,6 +148,8 @@ def get_metric(name: str, hf_evaluate_metric=False) -> Callable:
             )
 
     try:
+        import evaluate as hf_evaluate
+
         metric_object = hf_evaluate.load(name)
         return metric_object.compute
     except Exception:
@@ -1,4 +1,5 @@
-import datasets
+import json
+from typing import List, Tuple
 
 
 class ContextSampler:
@@ -21,13 +22,60 @@ class ContextSampler:
 
         self.docs = docs  # HF dataset split, provided by task._fewshot_docs()
         if fewshot_indices:  # subset few-shot docs from
+            import datasets
+
             if not isinstance(self.docs, datasets.Dataset):
                 raise ValueError(
                     "Got `fewshot_indices` but fewshot_docs are not a HF dataset. Don't use both `fewshot_indices` and a user-defined few-shot sample list simultaneously"
                 )
             self.docs = self.docs.select(fewshot_indices)
 
-    def get_context(self, doc, num_fewshot):
+        # few-shot docs are rendered on first use and reused for every eval doc,
+        # see `_render`; `_doc_keys` are hashes used to exclude the eval doc
+        self._rendered = [None] * len(self.docs)
+        self._doc_keys = [None] * len(self.docs)
+
+    @staticmethod
+    def _doc_key(doc) -> int:
+        return hash(json.dumps(doc, sort_keys=True, default=str))
+
+    def _render_doc(self, doc) -> Tuple[str, str, str]:
+        """Returns the text, the target and the chat target of a few-shot doc."""
+        doc_content = self.doc_to_text(doc)
+        doc_target = self.doc_to_target(doc)
+        text = (
+            doc_content
+            if self.config.doc_to_choice is None or isinstance(doc_content, str)
+            else self.doc_to_choice(doc)[doc_content]
+        )
+        target = (
+            str(doc_target[0])
+            if isinstance(doc_target, list)
+            else str(doc_target)
+            if self.config.doc_to_choice is None or isinstance(doc_target, str)
+            else str(self.doc_to_choice(doc)[doc_target])
+        )
+        chat_target = (
+            str(doc_target[0])
+            if isinstance(doc_target, list)
+            else doc_target
+            if self.config.doc_to_choice is None or isinstance(doc_target, str)
+            else str(self.doc_to_choice(doc)[doc_target])
+        )
+        return text, target, chat_target
+
+    def _render(self, i: int) -> Tuple[str, str, str]:
+        rendered = self._rendered[i]
+        if rendered is None:
+            rendered = self._rendered[i] = self._render_doc(self.docs[i])
+        return rendered
+
+    def _is_doc(self, i: int, doc, doc_key: int) -> bool:
+        if self._doc_keys[i] is None:
+            self._doc_keys[i] = self._doc_key(self.docs[i])
+        return self._doc_keys[i] == doc_key and self.docs[i] == doc
+
+    def _select(self, doc, num_fewshot) -> List[Tuple[str, str, str]]:
         # draw an extra fewshot sample if using same split as evaluating on
         n_samples = (
             num_fewshot + 1
@@ -35,30 +83,26 @@ class ContextSampler:
             else num_fewshot
         )
 
+        if type(self).sample is not ContextSampler.sample:
+            # subclasses that only override `sample` return docs rather than indices
+            fewshotex = self.sample(n_samples)
+            selected_docs = [x for x in fewshotex if x != doc][:num_fewshot]
+            return [self._render_doc(x) for x in selected_docs]
+
         # draw `n_samples` docs from fewshot_docs
-        fewshotex = self.sample(n_samples)
+        indices = self.sample_indices(n_samples)
 
         # get rid of the doc that's the one we're evaluating, if it's in the fewshot
-        # TODO: should we just stop people from using fewshot from same split as evaluating?
-        selected_docs = [x for x in fewshotex if x != doc][:num_fewshot]
+        doc_key = self._doc_key(doc)
+        indices = [i for i in indices if not self._is_doc(i, doc, doc_key)]
+        return [self._render(i) for i in indices[:num_fewshot]]
 
+    def get_context(self, doc, num_fewshot):
         labeled_examples = ""
-        for doc in selected_docs:
-            doc_content = self.doc_to_text(doc)
-            doc_target = self.doc_to_target(doc)
-            labeled_examples += (
-                doc_content
-                if self.config.doc_to_choice is None or isinstance(doc_content, str)
-                else self.doc_to_choice(doc)[doc_content]
-            )
+        for text, target, _ in self._select(doc, num_fewshot):
+            labeled_examples += text
             labeled_examples += self.target_delimiter
-            labeled_examples += (
-                str(doc_target[0])
-                if isinstance(doc_target, list)
-                else str(doc_target)
-                if self.config.doc_to_choice is None or isinstance(doc_target, str)
-                else str(self.doc_to_choice(doc)[doc_target])
-            )
+            labeled_examples += target
             labeled_examples += self.fewshot_delimiter
 
         return labeled_examples
@@ -70,43 +114,10 @@ class ContextSampler:
         fewshot_as_multiturn: bool = False,
     ):
         chat_history = []
-        # draw an extra fewshot sample if using same split as evaluating on
-        n_samples = (
-            num_fewshot + 1
-            if self.config.fewshot_split == self.config.test_split
-            else num_fewshot
-        )
-        # draw `n_samples` docs from fewshot_docs
-        fewshotex = self.sample(n_samples)
-
-        # get rid of the doc that's the one we're evaluating, if it's in the fewshot
-        # TODO: should we just stop people from using fewshot from same split as evaluating?
-        selected_docs = [x for x in fewshotex if x != doc][:num_fewshot]
-
         if fewshot_as_multiturn:
-            for doc in selected_docs:
-                doc_content = self.doc_to_text(doc)
-                doc_target = self.doc_to_target(doc)
-                chat_history.append(
-                    {
-                        "role": "user",
-                        "content": doc_content
-                        if self.config.doc_to_choice is None
-                        or isinstance(doc_content, str)
-                        else self.doc_to_choice(doc)[doc_content],
-                    }
-                )
-                chat_history.append(
-                    {
-                        "role": "assistant",
-                        "content": str(doc_target[0])
-                        if isinstance(doc_target, list)
-                        else doc_target
-                        if self.config.doc_to_choice is None
-                        or isinstance(doc_target, str)
-                        else str(self.doc_to_choice(doc)[doc_target]),
-                    }
-                )
+            for text, _, chat_target in self._select(doc, num_fewshot):
+                chat_history.append({"role": "user", "content": text})
+                chat_history.append({"role": "assistant", "content": chat_target})
         else:
             # get fewshot context as one user turn
             chat_history.append(
@@ -115,16 +126,24 @@ class ContextSampler:
 
         return chat_history
 
+    def sample_indices(self, n) -> List[int]:
+        """
+        Draw the indices of `n` samples from our fewshot docs. This method should be overridden by subclasses.
+        """
+
+        # draws the same docs as `self.rnd.sample(self.docs, n)`
+        return self.rnd.sample(range(len(self.docs)), n)
+
     def sample(self, n):
         """
-        Draw `n` samples from our fewshot docs. This method should be overridden by subclasses.
+        Draw `n` samples from our fewshot docs.
         """
 
-        return self.rnd.sample(self.docs, n)
+        return [self.docs[i] for i in self.sample_indices(n)]
 
 
 class FirstNSampler(ContextSampler):
-    def sample(self, n) -> None:
+    def sample_indices(self, n) -> List[int]:
         """
         Draw the first `n` samples in order from the specified split.
         Used for tasks with "canonical" ordered fewshot examples, such as MMLU and CMMLU.
@@ -132,7 +151,7 @@ class FirstNSampler(ContextSampler):
         assert (
             n <= len(self.docs)
         ), f"Error: number of fewshot samples requested exceeds the {len(self.docs)} that are available."
-        return self.docs[:n]
+        return list(range(n))
 
 
 class BalancedSampler(ContextSampler):
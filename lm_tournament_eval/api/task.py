@@ -1,12 +1,18 @@
+from __future__ import annotations
+
 import abc
 import ast
+import json
 import logging
+import math
+import multiprocessing
 import random
 import re
+import threading
 from collections.abc import Callable
 from copy import deepcopy
 from dataclasses import asdict, dataclass
-from inspect import getsource
+from inspect import getmodule, getsource
 from typing import (
     Any,
     Dict,
@@ -16,17 +22,17 @@ from typing import (
     Literal,
     Mapping,
     Optional,
+    TYPE_CHECKING,
     Tuple,
     Union,
 )
 
-import datasets
 import numpy as np
 from tqdm import tqdm
 
 from lm_tournament_eval import utils
 from lm_tournament_eval.api import samplers
-from lm_tournament_eval.api.instance import Instance, OutputType
+from lm_tournament_eval.api.instance import Instance, OutputType, use_response_table
 from lm_tournament_eval.api.metrics import bits_per_byte, mean, weighted_perplexity
 from lm_tournament_eval.api.registry import (
     AGGREGATION_REGISTRY,
@@ -36,10 +42,19 @@ from lm_tournament_eval.api.registry import (
     get_metric_aggregation,
     is_higher_better,
 )
-from lm_tournament_eval.caching.cache import load_from_cache, save_to_cache
+from lm_tournament_eval.caching.cache import (
+    load_dataset_from_cache,
+    load_requests_from_cache,
+    requests_cache_exists,
+    save_dataset_to_cache,
+    save_requests_to_cache,
+)
 from lm_tournament_eval.filters import build_filter_ensemble
 from lm_tournament_eval.prompts import get_prompt
 
+if TYPE_CHECKING:
+    import datasets
+
 
 ALL_OUTPUT_TYPES = [
     "loglikelihood",
@@ -184,6 +199,40 @@ class TaskConfig(dict):
                 return str(value)
 
 
+# (task, doc_id_docs, build kwargs) inherited by forked context-building workers
+_build_state = None
+
+
+def _can_fork() -> bool:
+    """
+    Whether forking context-building workers is safe: a lock held by another thread
+    at fork time (e.g. a logging handler or a download) stays locked in the workers.
+    tqdm's monitor thread is ignored, since the workers do not use tqdm.
+    """
+    from tqdm._monitor import TMonitor
+
+    others = [
+        thread
+        for thread in threading.enumerate()
+        if thread is not threading.current_thread() and not isinstance(thread, TMonitor)
+    ]
+    if others:
+        eval_logger.info(
+            f"Building contexts in a single process, since other threads are running: "
+            f"{', '.join(thread.name for thread in others)}"
+        )
+    return not others
+
+
+def _build_requests_chunk(bounds: Tuple[int, int]) -> List[List[Instance]]:
+    task, doc_id_docs, build_kwargs = _build_state
+    start, end = bounds
+    return [
+        task._build_doc_requests(doc_id, doc, **build_kwargs)
+        for doc_id, doc in doc_id_docs[start:end]
+    ]
+
+
 class Task(abc.ABC):
     """A task represents an entire benchmark including its dataset, problems,
     answers, and evaluation methods. See BoolQ for a simple example implementation
@@ -237,6 +286,10 @@ class Task(abc.ABC):
         self._training_docs: Optional[list] = None
         self._fewshot_docs: Optional[list] = None
         self._instances: Optional[List[Instance]] = None
+        # (limit, world_size) -> doc ids of each rank, see `doc_iterator`
+        self._shard_plans: Dict[Tuple[Optional[int], int], List[set]] = {}
+        # number of eval docs that will be used, see `set_eval_limit`
+        self._eval_docs_limit: Optional[int] = None
 
         self._config: TaskConfig = TaskConfig({**config}) if config else TaskConfig()
 
@@ -244,6 +297,7 @@ class Task(abc.ABC):
         self.fewshot_rnd: Optional[random.Random] = (
             None  # purposely induce errors in case of improper usage
         )
+        self.fewshot_seed: Optional[int] = None
 
     def download(
         self,
@@ -275,6 +329,8 @@ class Task(abc.ABC):
             - `datasets.DownloadMode.FORCE_REDOWNLOAD`
                 Fresh download and fresh dataset.
         """
+        import datasets
+
         self.dataset = datasets.load_dataset(
             path=self.DATASET_PATH,
             name=self.DATASET_NAME,
@@ -390,79 +446,85 @@ class Task(abc.ABC):
         fewshot_as_multiturn: bool = False,
         chat_template: Optional[Callable] = None,
         tokenizer_name: str = "",
+        num_proc: Optional[int] = None,
     ) -> None:
-        """Build a set of Instances for a task, and store them in task.instances"""
+        """Build a set of Instances for a task, and store them in task.instances.
+
+        With `num_proc` > 1, contexts are built by that many forked worker processes.
+        Few-shot examples are drawn with a generator seeded per doc, so both paths
+        build the same Instances.
+        """
 
         # used with caching
         og_limit = limit
 
-        cache_key = f"requests-{self._config.task}-{self.config.num_fewshot}shot-rank{rank}-world_size{world_size}"
-        cache_key += "-chat_template" if apply_chat_template else ""
-        cache_key += "-fewshot_as_multiturn" if fewshot_as_multiturn else ""
-        cache_key += (
-            f"-system_prompt_hash{utils.hash_string(system_instruction)}"
-            if system_instruction is not None
-            else ""
+        cache_key = self._requests_cache_key(
+            rank=rank,
+            world_size=world_size,
+            limit=limit,
+            system_instruction=system_instruction,
+            apply_chat_template=apply_chat_template,
+            fewshot_as_multiturn=fewshot_as_multiturn,
+            tokenizer_name=tokenizer_name,
         )
-        cache_key += f"-tokenizer{tokenizer_name}"
-
-        cached_instances = load_from_cache(file_name=cache_key)
-
-        if cache_requests and cached_instances and not rewrite_requests_cache:
-            cached_instances = cached_instances[:limit]
-
-            flattened_instances = [
-                instance
-                for instance_group in cached_instances
-                for instance in instance_group
-            ]
+        is_cached = requests_cache_exists(cache_key)
 
-            self._instances = flattened_instances
-            return
+        if cache_requests and is_cached and not rewrite_requests_cache:
+            # docs are cached in doc_id order, so a limit needs only a prefix
+            cached = load_requests_from_cache(
+                cache_key, max_doc_id=limit if world_size == 1 else None
+            )
+            if cached is not None:
+                self._instances = self._instances_from_cache(cached)
+                return
 
         eval_logger.info(f"Building contexts for {self.config.task} on rank {rank}...")
 
         instances = []
 
-        # process all documents when caching is specified for simplicity
+        # process all documents when caching is specified for simplicity. With several
+        # ranks the shard plan depends on the limit, which is part of the cache key instead.
         if (
             cache_requests
-            and (not cached_instances or rewrite_requests_cache)
+            and (not is_cached or rewrite_requests_cache)
             and limit is not None
+            and world_size == 1
         ):
             limit = None
 
-        doc_id_docs = list(
-            self.doc_iterator(rank=rank, limit=limit, world_size=world_size)
-        )
+        # the eval docs may be truncated to a limit, see `set_eval_limit`
+        eval_docs_limit = self._eval_docs_limit
+        if limit is None:
+            self.set_eval_limit(None)
+        try:
+            doc_id_docs = list(
+                self.doc_iterator(rank=rank, limit=limit, world_size=world_size)
+            )
+        finally:
+            self.set_eval_limit(eval_docs_limit)
 
         num_docs = len(doc_id_docs)
 
-        for doc_id, doc in tqdm(
-            doc_id_docs,
-            total=num_docs,
+        build_kwargs = dict(
+            system_instruction=system_instruction,
+            apply_chat_template=apply_chat_template,
+            fewshot_as_multiturn=fewshot_as_multiturn,
+            chat_template=chat_template,
+        )
+        if (
+            num_proc is not None
+            and num_proc > 1
+            and num_docs > num_proc
+            and self.fewshot_seed is not None
+            and "fork" in multiprocessing.get_all_start_methods()
+            and _can_fork()
         ):
-            # sample fewshot context #TODO: need to offset doc_id by rank now!
-            fewshot_ctx = self.fewshot_context(
-                doc,
-                0 if self.config.num_fewshot is None else self.config.num_fewshot,
-                system_instruction,
-                apply_chat_template,
-                fewshot_as_multiturn,
-                chat_template,
-            )
-
-            # TODO: we should override self.config.repeats if doing greedy gen so users don't waste time+compute
-            inst = self.construct_requests(
-                doc=doc,
-                ctx=fewshot_ctx,
-                metadata=(self.config["task"], doc_id, self.config.repeats),
-            )
-
-            if not isinstance(inst, list):
-                inst = [inst]
-
-            instances.append(inst)
+            instances = self._build_requests_parallel(doc_id_docs, num_proc, build_kwargs)
+        else:
+            instances = [
+                self._build_doc_requests(doc_id, doc, **build_kwargs)
+                for doc_id, doc in tqdm(doc_id_docs, total=num_docs)
+            ]
 
         # now flatten, this is to allow slicing to work with pickles
 
@@ -474,13 +536,141 @@ class Task(abc.ABC):
             for instance in instance_group
         ]
 
+        # all Instances of a doc share one entry of the task's doc table, and all
+        # Instances of the task share one table of responses
+        doc_table = {doc_id: doc for doc_id, doc in doc_id_docs}
+        for instance in flattened_instances:
+            instance.use_doc_table(doc_table)
+        use_response_table(flattened_instances)
+
         self._instances = flattened_instances
 
         if len(self._instances) == 0:
             raise ValueError("task.build_requests() did not find any docs!")
 
-        if cache_requests and (not cached_instances or rewrite_requests_cache):
-            save_to_cache(file_name=cache_key, obj=instances)
+        if cache_requests and (not is_cached or rewrite_requests_cache):
+            save_requests_to_cache(
+                cache_key,
+                [
+                    (
+                        instance_group[0].doc_id,
+                        [
+                            (instance.idx, instance.request_type, instance.arguments)
+                            for instance in instance_group
+                        ],
+                    )
+                    for instance_group in instances
+                ],
+            )
+
+    def _requests_cache_key(
+        self,
+        *,
+        rank: int,
+        world_size: int,
+        limit: Optional[int],
+        system_instruction: Optional[str],
+        apply_chat_template: bool,
+        fewshot_as_multiturn: bool,
+        tokenizer_name: str,
+    ) -> str:
+        """Builds the request cache key from everything the built requests depend on."""
+        fingerprint = self._eval_docs_fingerprint()
+        key_data = {
+            "config": self.dump_config(),
+            "dataset": fingerprint,
+            # a fingerprint identifies the docs, counting them may mean processing them all
+            "num_docs": self.num_eval_docs() if fingerprint is None else None,
+            "fewshot_seed": self.fewshot_seed,
+            "rank": rank,
+            "world_size": world_size,
+            # with several ranks, the docs of a rank depend on the limit
+            "limit": limit if world_size > 1 else None,
+            "system_instruction": system_instruction,
+            "apply_chat_template": apply_chat_template,
+            "fewshot_as_multiturn": fewshot_as_multiturn,
+            "tokenizer": tokenizer_name,
+        }
+        key_hash = utils.hash_string(json.dumps(key_data, sort_keys=True, default=str))
+        return f"requests-{self._config.task}-{key_hash[:16]}"
+
+    def _instances_from_cache(self, doc_requests) -> List[Instance]:
+        eval_docs = self.eval_docs
+        doc_table = {}
+        instances = []
+        for doc_id, requests in doc_requests:
+            doc_table[doc_id] = eval_docs[doc_id]
+            for idx, request_type, arguments in requests:
+                instances.append(
+                    Instance(
+                        request_type=request_type,
+                        doc=None,
+                        # JSON turns tuples into lists
+                        arguments=tuple(arguments) if isinstance(arguments, list) else arguments,
+                        idx=idx,
+                        metadata=(self.config["task"], doc_id, self.config.repeats),
+                    )
+                )
+                instances[-1].use_doc_table(doc_table)
+        use_response_table(instances)
+        return instances
+
+    def _build_doc_requests(
+        self,
+        doc_id: int,
+        doc,
+        system_instruction: Optional[str] = None,
+        apply_chat_template: bool = False,
+        fewshot_as_multiturn: bool = False,
+        chat_template: Optional[Callable] = None,
+    ) -> List[Instance]:
+        if self.fewshot_rnd is not None and self.fewshot_seed is not None:
+            # few-shot examples of a doc do not depend on which docs were built before it
+            self.fewshot_rnd.seed(f"{self.fewshot_seed}-{doc_id}")
+
+        # sample fewshot context
+        fewshot_ctx = self.fewshot_context(
+            doc,
+            0 if self.config.num_fewshot is None else self.config.num_fewshot,
+            system_instruction,
+            apply_chat_template,
+            fewshot_as_multiturn,
+            chat_template,
+        )
+
+        # repeats of greedy requests are deduplicated in `evaluate`, so they cost no extra compute
+        inst = self.construct_requests(
+            doc=doc,
+            ctx=fewshot_ctx,
+            metadata=(self.config["task"], doc_id, self.config.repeats),
+        )
+
+        if not isinstance(inst, list):
+            inst = [inst]
+        return inst
+
+    def _build_requests_parallel(self, doc_id_docs, num_proc: int, build_kwargs: dict) -> List[List[Instance]]:
+        global _build_state
+
+        chunk_size = math.ceil(len(doc_id_docs) / (num_proc * 4))
+        bounds = [
+            (start, min(start + chunk_size, len(doc_id_docs)))
+            for start in range(0, len(doc_id_docs), chunk_size)
+        ]
+        # workers are forked, so they inherit the task, its docs and the sampler
+        _build_state = (self, doc_id_docs, build_kwargs)
+        try:
+            with multiprocessing.get_context("fork").Pool(num_proc) as pool:
+                instances = []
+                for chunk in tqdm(
+                    pool.imap(_build_requests_chunk, bounds),
+                    total=len(bounds),
+                    desc=f"Building contexts with {num_proc} processes",
+                ):
+                    instances.extend(chunk)
+        finally:
+            _build_state = None
+        return instances
 
     @abc.abstractmethod
     def construct_requests(self, doc, ctx, **kwargs):
@@ -621,6 +811,16 @@ class Task(abc.ABC):
             eval_logger.warning("No filter defined, passing through instances")
             return self._instances
 
+    def config_hash(self) -> str:
+        """Hash of the config and few-shot seed, which determine the text of the requests."""
+        return utils.hash_string(
+            json.dumps(
+                {"config": self.dump_config(), "fewshot_seed": self.fewshot_seed},
+                sort_keys=True,
+                default=str,
+            )
+        )[:16]
+
     def dump_config(self) -> dict:
         """Returns the config as a dictionary."""
         # TODO: this should only return the overrides applied to a non-YAML task's configuration.
@@ -668,6 +868,7 @@ class Task(abc.ABC):
         setattr(self._config, "process_results", None)
 
     def set_fewshot_seed(self, seed: Optional[int] = None) -> None:
+        self.fewshot_seed = seed
         self.fewshot_rnd = random.Random(seed)
         if hasattr(self, "sampler"):
             self.sampler.rnd = self.fewshot_rnd
@@ -683,10 +884,48 @@ class Task(abc.ABC):
                 f"Task dataset (path={self.DATASET_PATH}, name={self.DATASET_NAME}) must have valid or test docs!"
             )
 
+    def set_eval_limit(self, limit: Optional[int]) -> None:
+        """
+        Declares that only the first `limit` eval docs will be used, so that `eval_docs`
+        may load and process only those.
+        """
+        self._eval_docs_limit = int(limit) if limit else None
+
+    def num_eval_docs(self) -> int:
+        """Number of eval docs in the whole split, regardless of `set_eval_limit`."""
+        return len(self.eval_docs)
+
+    def _eval_docs_fingerprint(self) -> Optional[str]:
+        return getattr(self.eval_docs, "_fingerprint", None)
+
+    def doc_cost(self, doc) -> float:
+        """Estimated compute cost of a document, used to balance documents across ranks."""
+        return 1.0
+
+    def shard_plan(self, limit: Union[int, None], world_size: int) -> List[set]:
+        """Returns the doc ids evaluated by each rank, balanced by `doc_cost`."""
+        key = (limit, world_size)
+        if key not in self._shard_plans:
+            costs = [
+                self.doc_cost(doc)
+                for doc in utils.create_iterator(self.eval_docs, limit=limit)
+            ]
+            self._shard_plans[key] = [
+                set(shard) for shard in utils.plan_balanced_shards(costs, world_size)
+            ]
+        return self._shard_plans[key]
+
     def doc_iterator(
         self, *, rank: int = 0, limit: Union[int, None] = None, world_size: int = 1
     ) -> Iterator[Tuple[int, Any]]:
         limit = int(limit) if limit else None
+        if int(world_size) > 1:
+            shard = self.shard_plan(limit, int(world_size))[int(rank)]
+            return (
+                (doc_id, doc)
+                for doc_id, doc in utils.create_iterator(enumerate(self.eval_docs), limit=limit)
+                if doc_id in shard
+            )
         doc_iterator = utils.create_iterator(
             enumerate(self.eval_docs),
             rank=int(rank),
@@ -819,9 +1058,14 @@ class ConfigurableTask(Task):
                     )
                     self._higher_is_better[metric_name] = is_higher_better(metric_name)
 
+        # (split, limit) -> processed docs, see `_split_docs`
+        self._split_docs_cache = {}
+        self._eval_docs_limit = None
         self.download(self.config.dataset_kwargs)
         self._training_docs = None
         self._fewshot_docs = None
+        self._shard_plans = {}
+        self.fewshot_seed = None
 
         if self.config.filter_list is not None:
             self._filters = []
@@ -872,13 +1116,18 @@ class ConfigurableTask(Task):
                     f"not {type(config_sampler)}"
                 )
 
-        self.task_docs = self.eval_docs
+        if self._uses_config_docs():
+            # one processed row is enough to check the prompt functions, the eval
+            # split is only processed once it is known how many docs are used
+            task_docs = self._split_docs(self._eval_split(), 1)
+        else:
+            task_docs = self.eval_docs
 
         # Test One Doc
-        self.features = list(self.task_docs.features.keys())
+        self.features = list(task_docs.features.keys())
         self.multiple_input = 0
         self.multiple_target = 0
-        test_doc = self.task_docs[0]
+        test_doc = task_docs[0]
         test_text = self.doc_to_text(test_doc)
         test_target = self.doc_to_target(test_doc)
 
@@ -926,6 +1175,8 @@ class ConfigurableTask(Task):
                     )
 
     def download(self, dataset_kwargs: Optional[Dict[str, Any]] = None) -> None:
+        import datasets
+
         self.dataset = datasets.load_dataset(
             path=self.DATASET_PATH,
             name=self.DATASET_NAME,
@@ -950,33 +1201,143 @@ class ConfigurableTask(Task):
         else:
             return False
 
+    def _processed_docs_key(self, docs) -> Optional[str]:
+        """
+        Cache key of `process_docs(docs)`: the fingerprint of `docs` and a hash of the
+        source of the module defining `process_docs` (which includes its helpers).
+        """
+        fingerprint = getattr(docs, "_fingerprint", None)
+        if fingerprint is None:
+            return None
+        process_docs = self.config.process_docs
+        try:
+            module = getmodule(process_docs)
+            source = getsource(module if module is not None else process_docs)
+        except (OSError, TypeError):
+            # e.g. functions defined interactively
+            return None
+        source_hash = utils.hash_string(f"{getattr(process_docs, '__qualname__', '')}\n{source}")
+        return f"processed_docs-{self._config.task}-{fingerprint}-{source_hash[:16]}"
+
+    def _load_processed_docs(self, key: Optional[str]):
+        if key is None:
+            return None
+        return load_dataset_from_cache(key, fingerprint=utils.hash_string(key))
+
+    def _process_split(self, docs):
+        if self.config.process_docs is None:
+            return docs
+        key = self._processed_docs_key(docs)
+        processed = self._load_processed_docs(key)
+        if processed is not None:
+            return processed
+
+        processed = self.config.process_docs(docs)
+        if key is not None and hasattr(processed, "_indices"):
+            try:
+                save_dataset_to_cache(key, processed)
+            except Exception as e:
+                eval_logger.debug(f"Could not cache processed docs of {self._config.task}: {e}")
+        return processed
+
+    def _split_docs(self, split: str, limit: Optional[int] = None):
+        """
+        Returns the docs of `split` after `process_docs`. With a `limit`, at least the
+        first `limit` processed docs are returned, and only a prefix of the split
+        is processed; this assumes `process_docs` maps or filters rows in order.
+        """
+        key = (split, limit)
+        if key not in self._split_docs_cache:
+            docs = self.dataset[split]
+            full = self._split_docs_cache.get((split, None))
+            if limit is not None and full is not None:
+                # the whole split is already processed
+                processed = (
+                    full.select(range(min(limit, len(full))))
+                    if hasattr(full, "select")
+                    else full[:limit]
+                )
+            elif limit is not None and limit < len(docs):
+                num_rows = limit
+                while True:
+                    head = (
+                        docs.select(range(num_rows))
+                        if hasattr(docs, "select")
+                        else docs[:num_rows]
+                    )
+                    processed = self._process_split(head)
+                    # rows may have been filtered out, process a longer prefix
+                    if len(processed) >= limit or num_rows >= len(docs):
+                        break
+                    num_rows = min(len(docs), 2 * num_rows)
+            else:
+                processed = self._process_split(docs)
+            self._split_docs_cache[key] = processed
+        return self._split_docs_cache[key]
+
+    def _uses_config_docs(self) -> bool:
+        # python tasks may override how their eval docs are loaded
+        return (
+            type(self).test_docs is ConfigurableTask.test_docs
+            and type(self).validation_docs is ConfigurableTask.validation_docs
+        )
+
+    def _eval_split(self) -> str:
+        if self.has_test_docs():
+            return self.config.test_split
+        elif self.has_validation_docs():
+            return self.config.validation_split
+        else:
+            raise ValueError(
+                f"Task dataset (path={self.DATASET_PATH}, name={self.DATASET_NAME}) must have valid or test docs!"
+            )
+
+    @property
+    def eval_docs(self) -> Union[datasets.Dataset, List[dict]]:
+        if not self._uses_config_docs():
+            return super().eval_docs
+        return self._split_docs(self._eval_split(), self._eval_docs_limit)
+
+    def _eval_docs_fingerprint(self) -> Optional[str]:
+        if not self._uses_config_docs():
+            return super()._eval_docs_fingerprint()
+        # `process_docs` is part of the config, so the unprocessed split identifies the docs
+        return getattr(self.dataset[self._eval_split()], "_fingerprint", None)
+
+    def num_eval_docs(self) -> int:
+        if not self._uses_config_docs():
+            return super().num_eval_docs()
+        split = self._eval_split()
+        if self.config.process_docs is None or self._has_processed_split(split):
+            return len(self._split_docs(split))
+        # counting the processed docs would mean processing the whole split, so this
+        # is the number of docs before `process_docs` until the split is processed
+        return len(self.dataset[split])
+
+    def _has_processed_split(self, split: str) -> bool:
+        """Whether the whole processed `split` is in memory, or can be loaded from the cache."""
+        if (split, None) not in self._split_docs_cache:
+            processed = self._load_processed_docs(self._processed_docs_key(self.dataset[split]))
+            if processed is None:
+                return False
+            self._split_docs_cache[(split, None)] = processed
+        return True
+
     def training_docs(self) -> datasets.Dataset:
         if self.has_training_docs():
-            if self.config.process_docs is not None:
-                return self.config.process_docs(
-                    self.dataset[self.config.training_split]
-                )
-            return self.dataset[self.config.training_split]
+            return self._split_docs(self.config.training_split)
 
     def validation_docs(self) -> datasets.Dataset:
         if self.has_validation_docs():
-            if self.config.process_docs is not None:
-                return self.config.process_docs(
-                    self.dataset[self.config.validation_split]
-                )
-            return self.dataset[self.config.validation_split]
+            return self._split_docs(self.config.validation_split)
 
     def test_docs(self) -> datasets.Dataset:
         if self.has_test_docs():
-            if self.config.process_docs is not None:
-                return self.config.process_docs(self.dataset[self.config.test_split])
-            return self.dataset[self.config.test_split]
+            return self._split_docs(self.config.test_split)
 
     def fewshot_docs(self):
         if self.config.fewshot_split is not None:
-            if self.config.process_docs is not None:
-                return self.config.process_docs(self.dataset[self.config.fewshot_split])
-            return self.dataset[self.config.fewshot_split]
+            return self._split_docs(self.config.fewshot_split)
         elif (
             self.config.fewshot_config is not None
             and self.config.fewshot_config.get("samples", None) is not None
@@ -1273,6 +1634,27 @@ class ConfigurableTask(Task):
         else:
             raise TypeError
 
+    # rough characters per token, to weigh generated tokens against prompt characters
+    CHARS_PER_TOKEN = 4
+
+    def doc_cost(self, doc) -> float:
+        """
+        Estimates the cost of a document from the length of its prompt and
+        continuations in characters (the tokenizer is not known to the task), times
+        the number of requests for multiple choice.
+        """
+        text_len = len(str(self.doc_to_text(doc)))
+        if self.OUTPUT_TYPE == "multiple_choice":
+            choices = self.doc_to_choice(doc)
+            n_requests = len(choices) * (2 if "acc_mutual_info" in self._metric_fn_list else 1)
+            return n_requests * (text_len + max((len(str(c)) for c in choices), default=0))
+        elif self.OUTPUT_TYPE == "generate_until":
+            max_gen_toks = (self.config.generation_kwargs or {}).get("max_gen_toks", 256)
+            return text_len + self.CHARS_PER_TOKEN * max_gen_toks
+        elif self.OUTPUT_TYPE == "loglikelihood_rolling":
+            return len(str(self.doc_to_target(doc)))
+        return text_len + len(str(self.doc_to_target(doc)))
+
     def construct_requests(
         self, doc: dict, ctx: str, **kwargs
     ) -> Union[List[Instance], Instance]:
@@ -1541,7 +1923,7 @@ class ConfigurableTask(Task):
             f"ConfigurableTask(task_name={getattr(self.config, 'task', None)},"
             f"output_type={self.OUTPUT_TYPE},"
             f"num_fewshot={getattr(self.config, 'num_fewshot', None)},"
-            f"num_samples={len(self.eval_docs)})"
+            f"num_samples={self.num_eval_docs()})"
         )
 
 
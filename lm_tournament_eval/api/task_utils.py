@@ -1,3 +1,4 @@
+import copy
 import torch
 from lm_tournament_eval.tasks import (
     TaskManager,
@@ -9,6 +10,7 @@ from lm_tournament_eval.evaluator_utils import (
     get_sample_size,
     print_writeout
 )
+from lm_tournament_eval.api.instance import use_response_table
 from lm_tournament_eval.api.task import Task
 
 from lm_tournament_eval.utils import eval_logger
@@ -16,18 +18,16 @@ from collections import defaultdict
 from typing import Optional, Union, Dict, List, Tuple
 
 
-def create_requests(lm, tasks, task_manager, verbosity, limit, 
-                    predict_only: bool = False, 
-                    num_fewshot: Optional[int] = None,
-                    fewshot_random_seed: int = 1234,
-                    cache_requests: bool = False,
-                    rewrite_requests_cache: bool = False,
-                    apply_chat_template: bool = False,
-                    fewshot_as_multiturn: bool = False,
-                    system_instruction: Optional[str] = None,
-                    write_out: bool = False,
-                    log_samples: bool = True    
+def load_tasks(tasks, task_manager, verbosity,
+               predict_only: bool = False,
+               num_fewshot: Optional[int] = None,
+               fewshot_random_seed: int = 1234,
+               gen_kwargs: Optional[dict] = None
     ):
+    '''
+    Loads the task dict of `tasks` and applies the config overrides (num_fewshot,
+    predict_only, fewshot seed, generation kwargs) to its leaf tasks.
+    '''
     if task_manager is None:
         task_manager = TaskManager(verbosity)
 
@@ -93,11 +93,32 @@ def create_requests(lm, tasks, task_manager, verbosity, limit,
         return adjusted_task_dict
 
     task_dict = _adjust_config(task_dict)
+    return task_dict
+
+
+def create_requests(lm, tasks, task_manager, verbosity, limit, 
+                    predict_only: bool = False, 
+                    num_fewshot: Optional[int] = None,
+                    fewshot_random_seed: int = 1234,
+                    cache_requests: bool = False,
+                    rewrite_requests_cache: bool = False,
+                    apply_chat_template: bool = False,
+                    fewshot_as_multiturn: bool = False,
+                    system_instruction: Optional[str] = None,
+                    write_out: bool = False,
+                    log_samples: bool = True,
+                    num_proc: Optional[int] = None
+    ):
+    task_dict = load_tasks(tasks, task_manager, verbosity,
+                           predict_only=predict_only,
+                           num_fewshot=num_fewshot,
+                           fewshot_random_seed=fewshot_random_seed)
 
     # tracks all Instances/requests a model must generate output on.
     requests = defaultdict(list)
     # stores the amount to pad out reqs per req. type so that
-    # number of fwd passes per distributed rank is equal
+    # number of fwd passes per distributed rank is equal. Padding requests are
+    # sentinels (see `evaluate`), docs themselves are balanced by `Task.shard_plan`
     padding_requests = defaultdict(int)
 
     # get lists of group hierarchy and each type of request
@@ -112,6 +133,7 @@ def create_requests(lm, tasks, task_manager, verbosity, limit,
     for task_output in eval_tasks:
         task: Task = task_output.task
         limit = get_sample_size(task, limit)
+        task.set_eval_limit(limit)
         task.build_all_requests(
             limit=limit,
             rank=lm.rank,
@@ -127,6 +149,7 @@ def create_requests(lm, tasks, task_manager, verbosity, limit,
             tokenizer_name=getattr(lm, "tokenizer_name", "")
             if apply_chat_template
             else "",
+            num_proc=num_proc,
         )
         eval_logger.debug(
             f"Task: {task_output.task_name}; number of requests on this rank: {len(task.instances)}"
@@ -154,4 +177,35 @@ def create_requests(lm, tasks, task_manager, verbosity, limit,
             # todo: may not account for padding in cases like SquadV2 which has multiple req types
             padding_requests[reqtype] += numpad
         
-    return requests, eval_tasks, task_dict, padding_requests
\ No newline at end of file
+    return requests, eval_tasks, task_dict, padding_requests
+
+
+def make_request_view(eval_tasks, task_dict):
+    '''
+    Returns (requests, eval_tasks, task_dict) sharing the docs, contexts and
+    arguments of already built requests, but with empty `resps`/`filtered_resps`
+    and fresh TaskOutputs, so that another model can be evaluated on the same
+    requests without building them again. Requests built with a chat template
+    are specific to the tokenizer they were built with.
+    '''
+    def _copy_task(task: Task) -> Task:
+        view = copy.copy(task)
+        instances = [copy.copy(instance) for instance in task.instances]
+        # the copies store their (empty) responses in a table of their own
+        use_response_table(instances)
+        view._instances = instances
+        return view
+
+    def _copy_task_dict(task_dict):
+        return {
+            name: _copy_task_dict(obj) if isinstance(obj, dict) else _copy_task(obj)
+            for name, obj in task_dict.items()
+        }
+
+    view_task_dict = _copy_task_dict(task_dict)
+    view_eval_tasks = get_task_list(view_task_dict)
+    requests = defaultdict(list)
+    for task_output in view_eval_tasks:
+        for instance in task_output.task.instances:
+            requests[instance.request_type].append(instance)
+    return requests, view_eval_tasks, view_task_dict
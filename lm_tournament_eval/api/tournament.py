@@ -1,5 +1,6 @@
 # this is a collection of matches, models, and a schedule of "play"
 
+import gc
 import logging
 import time
 import random
@@ -10,9 +11,16 @@ from dataclasses import dataclass
 from lm_tournament_eval.caching.cache import delete_cache
 
 from lm_tournament_eval.tasks import TaskManager
-from lm_tournament_eval.api.task_utils import create_requests
-from lm_tournament_eval.api.model_utils import load_model
-from lm_tournament_eval.tournament_evaluator import evaluate
+from lm_tournament_eval.api.task_utils import create_requests, load_tasks, make_request_view
+from lm_tournament_eval.evaluator_utils import get_task_list
+from lm_tournament_eval.api.model import CachingLM
+from lm_tournament_eval.api.model_utils import (
+    load_model,
+    available_host_memory,
+    estimate_model_bytes,
+    prefetch_model_files
+)
+from lm_tournament_eval.tournament_evaluator import evaluate, evaluate_streaming
 from lm_tournament_eval.utils import simple_parse_args_string
 
 from typing import Optional, Union, Dict, List, Tuple
@@ -36,10 +44,17 @@ class TournamentConfig:
     model1_args : str
     task_names : str
     rounds : int
-    batch_size : int
+    batch_size : Union[int, str]
     device : str
     limit : int
     match_size : int
+    assisted_decoding : bool = False
+    use_cache : Optional[str] = None
+    max_batch_size : int = 64
+    server_socket : Optional[str] = None
+    residency : str = "auto"
+    num_proc : Optional[int] = None
+    streaming : bool = False
 
 class Tournament:
     def __init__(self, config : TournamentConfig, tasks, task_manager, verbosity, initial_elos=None, elo_out=None):
@@ -66,11 +81,18 @@ class Tournament:
             if "load_in_8bit" in config.model1_args:
                 model1_bpw = '8'
 
+        self.model0_bpw = model0_bpw
+        self.model1_bpw = model1_bpw
+
         model0_key = (config.model0_name, model0_bpw)
         model1_key = (config.model1_name, model1_bpw)
 
         self.elo = ELO(model0_key, model1_key, initial_elos, elo_out)
 
+        # per-doc metrics of each model, filled in while streaming evaluation runs:
+        # outcomes[idx][(task_name, filter_key)][doc_id] = metrics
+        self.outcomes = {0: {}, 1: {}}
+
     def tournament_evaluate(
         self,
         model: str,
@@ -90,7 +112,9 @@ class Tournament:
         random_seed: int = 0,
         numpy_random_seed: int = 1234,
         torch_random_seed: int = 1234,
-        fewshot_random_seed: int = 1234
+        fewshot_random_seed: int = 1234,
+        streaming: bool = False,
+        on_outcome=None
     ) -> Dict:
 
         start_date = time.time()
@@ -125,16 +149,33 @@ class Tournament:
             if gen_kwargs == "":
                 gen_kwargs = None
 
-        # We don't currently support CachingLM
+        if use_cache is not None:
+            logging.info(f"Using cache at {use_cache}_rank{lm.rank}.db")
+            model_lm = CachingLM(
+                lm,
+                f"{use_cache}_rank{lm.rank}.db",
+                fingerprint=f"{model}|{model_args}",
+            )
+        else:
+            model_lm = lm
 
-        results = evaluate(
-            lm=lm,
-            requests=requests,
-            eval_tasks=eval_tasks,
-            task_dict=task_dict,
-            padding_requests=padding_requests,
-            limit=limit,
-        )
+        if streaming:
+            results = evaluate_streaming(
+                lm=model_lm,
+                eval_tasks=eval_tasks,
+                task_dict=task_dict,
+                limit=limit,
+                on_outcome=on_outcome,
+            )
+        else:
+            results = evaluate(
+                lm=model_lm,
+                requests=requests,
+                eval_tasks=eval_tasks,
+                task_dict=task_dict,
+                padding_requests=padding_requests,
+                limit=limit,
+            )
 
         # post-process results
         if lm.rank == 0:
@@ -150,7 +191,7 @@ class Tournament:
                 "model_args": model_args,
             }
 
-            if isinstance(lm, HFLM):
+            if hasattr(lm, "get_model_info"):
                 results["config"].update(lm.get_model_info())
 
             results["config"].update(
@@ -180,59 +221,198 @@ class Tournament:
 
         return results
 
-    def run_tournament(self):
-        model0 = load_model("hf", 
-                            self.config.model0_name,
-                            self.config.model0_args,
-                            batch_size=self.config.batch_size,
-                            max_batch_size=self.config.batch_size,
-                            device=self.config.device)
-
-        model1 = load_model("hf",
-                            self.config.model1_name,
-                            self.config.model1_args,
-                            batch_size=self.config.batch_size,
-                            max_batch_size=self.config.batch_size,
-                            device=self.config.device)
-
-        requests0, eval_tasks0, task_dict0, padding_reqests0 = create_requests(model0,
-                                                                               self.tasks,
-                                                                               self.task_manager,
-                                                                               self.verbosity,
-                                                                               self.config.limit)
-                #TODO: add all the other params here so that build_all_requests is happy 
-        requests1, eval_tasks1, task_dict1, padding_reqests1 = create_requests(model1,
-                                                                               self.tasks,
-                                                                               self.task_manager,
-                                                                               self.verbosity,
-                                                                               self.config.limit)
+    def _max_batch_size(self) -> int:
+        # with batch_size="auto" the per-batch request count is capped separately
+        if self.config.batch_size == "auto":
+            return self.config.max_batch_size
+        return self.config.batch_size
+
+    def setup_assisted_decoding(self, model0: HFLM, model1: HFLM) -> None:
+        '''
+        Use the smaller (quantized) competitor as a draft model for the larger
+        (full-precision) one in `generate_until`. Both models must already be loaded.
+        '''
+        if not (isinstance(model0, HFLM) and isinstance(model1, HFLM)):
+            logging.warning("Assisted decoding requires two locally loaded HF models, skipping.")
+            return
+
+        if int(self.model0_bpw) != int(self.model1_bpw):
+            target, draft = (
+                (model0, model1)
+                if int(self.model0_bpw) > int(self.model1_bpw)
+                else (model1, model0)
+            )
+        else:
+            params0 = model0.get_model_info()["model_num_parameters"]
+            params1 = model1.get_model_info()["model_num_parameters"]
+            if params0 == params1:
+                logging.info("Competitors have the same size, not using assisted decoding.")
+                return
+            target, draft = (model0, model1) if params0 > params1 else (model1, model0)
+
+        if target.set_assistant_model(draft):
+            name = self.config.model0_name if target is model0 else self.config.model1_name
+            logging.info(f"Using the other competitor as a draft model for {name}.")
+
+    def _load(self, idx: int):
+        return load_model("hf",
+                          getattr(self.config, f"model{idx}_name"),
+                          getattr(self.config, f"model{idx}_args"),
+                          batch_size=self.config.batch_size,
+                          max_batch_size=self._max_batch_size(),
+                          device=self.config.device,
+                          server_socket=self.config.server_socket,
+                          use_server=self.config.server_socket is not None)
+
+    def _streaming(self, lm) -> bool:
+        if self.config.streaming and lm.world_size > 1:
+            logging.warning("Streaming evaluation only supports a single process, building all requests upfront.")
+            return False
+        return self.config.streaming
+
+    def _build_requests(self, lm):
+        '''
+        Builds the requests of all tasks once. `lm` is only used for its rank and
+        world size, the requests themselves do not depend on the model. When
+        streaming, only the tasks are loaded and requests are built during evaluation.
+        '''
+        if self._streaming(lm):
+            task_dict = load_tasks(self.tasks, self.task_manager, self.verbosity)
+            return None, task_dict, None
+        _, eval_tasks, task_dict, padding_requests = create_requests(lm,
+                                                                     self.tasks,
+                                                                     self.task_manager,
+                                                                     self.verbosity,
+                                                                     self.config.limit,
+                                                                     num_proc=self.config.num_proc)
                 #TODO: add all the other params here so that build_all_requests is happy 
+        return eval_tasks, task_dict, padding_requests
+
+    def _record_outcome(self, idx: int, task_name: str, doc_id: int, filter_key: str, metrics: Dict) -> None:
+        self.outcomes[idx].setdefault((task_name, filter_key), {})[doc_id] = metrics
+
+    def _evaluate(self, idx: int, lm, built) -> Dict:
+        eval_tasks, task_dict, padding_requests = built
+        streaming = eval_tasks is None
+        if streaming:
+            # fresh TaskOutputs per model, the requests are built while evaluating
+            requests, eval_tasks = None, get_task_list(task_dict)
+        else:
+            # every model gets its own view of the shared requests to store responses in
+            requests, eval_tasks, task_dict = make_request_view(eval_tasks, task_dict)
+        self.outcomes[idx] = {}
+        return self.tournament_evaluate(model=getattr(self.config, f"model{idx}_name"),
+                                        lm=lm,
+                                        model_args=getattr(self.config, f"model{idx}_args"),
+                                        requests=requests,
+                                        eval_tasks=eval_tasks,
+                                        task_dict=task_dict,
+                                        padding_requests=padding_requests,
+                                        batch_size=self.config.batch_size,
+                                        device=self.config.device,
+                                        use_cache=self.config.use_cache,
+                                        limit=self.config.limit,
+                                        streaming=streaming,
+                                        on_outcome=lambda *outcome: self._record_outcome(idx, *outcome)
+                                    )
+
+    def plan_residency(self) -> str:
+        '''
+        Decides whether both models are kept in memory at the same time ("concurrent")
+        or loaded, evaluated and freed one after the other ("sequential").
+        '''
+        residency = self.config.residency
+        if residency not in ("auto", "concurrent", "sequential"):
+            raise ValueError(f"Unknown residency {residency}, expected auto|concurrent|sequential")
+
+        if self.config.assisted_decoding:
+            # the draft model must be resident next to the target model
+            if residency == "sequential":
+                logging.warning("Assisted decoding needs both models loaded, using concurrent residency.")
+            return "concurrent"
+        if residency != "auto":
+            return residency
+
+        device = str(self.config.device)
+        free = self._free_memory(device)
+        if free is None:
+            logging.info(f"Cannot tell the free memory of device {device}, so the models are loaded one at a time.")
+            return "sequential"
+        names = [self.config.model0_name, self.config.model1_name]
+        sizes = [
+            estimate_model_bytes(self.config.model0_name, self.config.model0_args),
+            estimate_model_bytes(self.config.model1_name, self.config.model1_args),
+        ]
+        unknown = [name for name, size in zip(names, sizes) if size is None]
+        if unknown:
+            logging.info(f"Cannot estimate the size of {', '.join(map(str, unknown))}, so the models are loaded one at a time.")
+            return "sequential"
+        # leave headroom for activations and the KV cache
+        residency = "concurrent" if sum(sizes) < 0.8 * free else "sequential"
+        logging.info(
+            f"The models need about {sum(sizes) / 2**30:.1f} GiB and {free / 2**30:.1f} GiB "
+            f"of {device} memory is free, so they are loaded {'together' if residency == 'concurrent' else 'one at a time'}."
+        )
+        return residency
+
+    @staticmethod
+    def _free_memory(device: str) -> Optional[int]:
+        if device.startswith("cuda"):
+            if not torch.cuda.is_available():
+                return None
+            free, _ = torch.cuda.mem_get_info(torch.device(device))
+            return free
+        if device == "cpu":
+            return available_host_memory()
+        return None
+
+    @staticmethod
+    def _release_memory() -> None:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def run_tournament(self):
+        residency = self.plan_residency()
+        logging.info(f"Using {residency} model residency.")
+
+        if residency == "concurrent":
+            model0 = self._load(0)
+            model1 = self._load(1)
+
+            if self.config.assisted_decoding:
+                self.setup_assisted_decoding(model0, model1)
+
+            built = self._build_requests(model0)
+            results0 = self._evaluate(0, model0, built)
+            results1 = self._evaluate(1, model1, built)
+            rank = model0.rank
+            model0.close()
+            model1.close()
+        else:
+            # only one model is resident at a time; the weights of the second model
+            # are read from disk while the first one is being evaluated. Requests are
+            # built before the prefetch thread starts, since building may fork.
+            model0 = self._load(0)
+            built = self._build_requests(model0)
+            prefetch = prefetch_model_files(self.config.model1_name, self.config.model1_args)
+            results0 = self._evaluate(0, model0, built)
+            rank = model0.rank
+            # worker processes of the model hold on to its weights
+            model0.close()
+            del model0
+            self._release_memory()
+
+            prefetch.join()
+            model1 = self._load(1)
+            results1 = self._evaluate(1, model1, built)
+            model1.close()
+            del model1
+            self._release_memory()
 
-        results0 = self.tournament_evaluate(model=self.config.model0_name,
-                                            lm=model0,
-                                            model_args=self.config.model0_args,
-                                            requests=requests0,
-                                            eval_tasks=eval_tasks0,
-                                            task_dict=task_dict0,
-                                            padding_requests=padding_reqests0,
-                                            batch_size=self.config.batch_size,
-                                            device=self.config.device,
-                                            limit=self.config.limit
-                                        )
-        results1 = self.tournament_evaluate(model=self.config.model1_name,
-                                            lm=model1,
-                                            model_args=self.config.model1_args,
-                                            requests=requests1,
-                                            eval_tasks=eval_tasks1,
-                                            task_dict=task_dict1,
-                                            padding_requests=padding_reqests1,
-                                            batch_size=self.config.batch_size,
-                                            device=self.config.device,
-                                            limit=self.config.limit
-                                        )
         rounds_per_task = []
         match_results = {}
-        if model0._rank == 0:
+        if rank == 0:
             for i,task_name in enumerate(self.config.task_names):
                 print(len(results0["samples"][task_name]))
                 rounds_per_task.append(len(results0["samples"][task_name])//self.config.match_size)
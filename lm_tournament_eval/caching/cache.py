@@ -1,17 +1,33 @@
+import bisect
+import contextlib
 import hashlib
+import io
+import json
 import os
-
-import dill
+import sqlite3
+import tempfile
+import time
+from array import array
+from typing import Iterator, List, Optional, Tuple
 
 from lm_tournament_eval.utils import eval_logger
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows, writes are still atomic but unlocked
+    fcntl = None
 
-MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 OVERRIDE_PATH = os.getenv("LM_HARNESS_CACHE_PATH")
 
+DEFAULT_PATH = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "lm_tournament_eval"
+)
+
+PATH = OVERRIDE_PATH if OVERRIDE_PATH else DEFAULT_PATH
 
-PATH = OVERRIDE_PATH if OVERRIDE_PATH else f"{MODULE_DIR}/.cache"
+# byte budget of the cache, least recently used entries are evicted beyond it
+MAX_BYTES = int(os.getenv("LM_HARNESS_CACHE_MAX_BYTES", 10 * 2**30))
 
 # This should be sufficient for uniqueness
 HASH_INPUT = "EleutherAI-lm-evaluation-harness"
@@ -20,36 +36,278 @@ HASH_PREFIX = hashlib.sha256(HASH_INPUT.encode("utf-8")).hexdigest()
 
 FILE_SUFFIX = f".{HASH_PREFIX}.pickle"
 
+# compact request caches: a binary index of doc ids and offsets followed by one JSON line per doc
+REQUESTS_SUFFIX = f".{HASH_PREFIX}.requests"
+
+# processed splits, stored as Arrow streams like the files of `datasets`
+DATASET_SUFFIX = f".{HASH_PREFIX}.arrow"
+
+
+class CacheStore:
+    """
+    A directory of cache entries that is safe to share between processes.
+
+    Entries are stored under `root/<2 hex chars>/<sha256 of key>`, written to a
+    temporary file and renamed into place, so readers never see partial entries.
+    Writers and evictions of the same key are serialized with a file lock. An
+    SQLite index tracks the key, size and last access of every entry, and least
+    recently used entries are evicted once the store exceeds `max_bytes`.
+    """
+
+    def __init__(self, root: str = PATH, max_bytes: Optional[int] = MAX_BYTES) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        with self._index() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, size INTEGER, last_access REAL)"
+            )
+
+    @contextlib.contextmanager
+    def _index(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=60)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    @contextlib.contextmanager
+    def _lock(self, key: str) -> Iterator[None]:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def open(self, key: str) -> Iterator[Optional[io.BufferedReader]]:
+        """Opens the entry of `key` for reading, or yields None if it does not exist."""
+        try:
+            file = open(self.path(key), "rb")
+        except FileNotFoundError:
+            with self._index() as db:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            yield None
+            return
+        with self._index() as db:
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        with file:
+            yield file
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    @contextlib.contextmanager
+    def writer(self, key: str) -> Iterator[io.BufferedWriter]:
+        """
+        Yields a file to write the entry of `key` to. The entry replaces any
+        previous one atomically when the block exits without an exception.
+        """
+        path = self.path(key)
+        with self._lock(key):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    yield file
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            with self._index() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                    (key, os.path.getsize(path), time.time()),
+                )
+        if self.max_bytes is not None:
+            self.prune(max_bytes=self.max_bytes)
+
+    def delete(self, key: str) -> None:
+        with self._lock(key):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path(key))
+            with self._index() as db:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def entries(self, prefix: str = "") -> List[Tuple[str, int, float]]:
+        """Returns (key, size, last_access) of all entries, least recently used first."""
+        with self._index() as db:
+            return db.execute(
+                "SELECT key, size, last_access FROM entries WHERE key LIKE ? ESCAPE '\\' "
+                "ORDER BY last_access",
+                (prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",),
+            ).fetchall()
+
+    def prune(
+        self,
+        max_bytes: Optional[int] = None,
+        older_than: Optional[float] = None,
+        prefix: str = "",
+    ) -> List[str]:
+        """
+        Deletes entries matching `prefix` that were last used more than `older_than`
+        seconds ago, then least recently used entries until the store holds at most
+        `max_bytes`. Returns the deleted keys.
+        """
+        entries = self.entries(prefix)
+        total = sum(size for _, size, _ in self.entries())
+        now = time.time()
+        deleted = []
+        for key, size, last_access in entries:
+            expired = older_than is not None and now - last_access > older_than
+            over_budget = max_bytes is not None and total > max_bytes
+            if not (expired or over_budget):
+                continue
+            self.delete(key)
+            total -= size
+            deleted.append(key)
+        if deleted:
+            eval_logger.debug(f"Evicted {len(deleted)} cache entries")
+        return deleted
+
+
+_store = None
+
+
+def get_store() -> CacheStore:
+    global _store
+    if _store is None:
+        _store = CacheStore()
+    return _store
+
 
 def load_from_cache(file_name):
     try:
-        path = f"{PATH}/{file_name}{FILE_SUFFIX}"
-
-        with open(path, "rb") as file:
-            cached_task_dict = dill.loads(file.read())
-            return cached_task_dict
+        with get_store().open(f"{file_name}{FILE_SUFFIX}") as file:
+            if file is not None:
+                import dill
 
+                return dill.loads(file.read())
     except Exception:
-        eval_logger.debug(f"{file_name} is not cached, generating...")
         pass
+    eval_logger.debug(f"{file_name} is not cached, generating...")
 
 
 def save_to_cache(file_name, obj):
-    if not os.path.exists(PATH):
-        os.mkdir(PATH)
-
-    file_path = f"{PATH}/{file_name}{FILE_SUFFIX}"
+    import dill
 
-    eval_logger.debug(f"Saving {file_path} to cache...")
-    with open(file_path, "wb") as file:
+    eval_logger.debug(f"Saving {file_name} to cache...")
+    with get_store().writer(f"{file_name}{FILE_SUFFIX}") as file:
         file.write(dill.dumps(obj))
 
 
+def requests_cache_exists(file_name) -> bool:
+    return get_store().exists(f"{file_name}{REQUESTS_SUFFIX}")
+
+
+def save_requests_to_cache(file_name, doc_requests: List[Tuple[int, list]]) -> None:
+    """
+    Stores the requests of a task as `(doc_id, [(idx, request_type, arguments), ...])`
+    per doc, sorted by doc_id. Docs are not stored, they are re-attached on load.
+    """
+    eval_logger.debug(f"Saving {file_name} to cache...")
+    doc_ids = array("q")
+    offsets = array("q", [0])
+    lines = []
+    try:
+        for doc_id, requests in sorted(doc_requests, key=lambda x: x[0]):
+            line = json.dumps([doc_id, requests], ensure_ascii=False).encode("utf-8") + b"\n"
+            lines.append(line)
+            doc_ids.append(doc_id)
+            offsets.append(offsets[-1] + len(line))
+    except TypeError as e:
+        # arguments that are not JSON serializable are not cached
+        eval_logger.debug(f"Not caching {file_name}: {e}")
+        return
+
+    with get_store().writer(f"{file_name}{REQUESTS_SUFFIX}") as file:
+        array("q", [len(doc_ids)]).tofile(file)
+        doc_ids.tofile(file)
+        offsets.tofile(file)
+        file.writelines(lines)
+
+
+def load_requests_from_cache(
+    file_name, max_doc_id: Optional[int] = None
+) -> Optional[List[Tuple[int, list]]]:
+    """
+    Loads cached requests of all docs with `doc_id < max_doc_id` (all docs if None),
+    reading only that prefix of the cache entry. Returns None if nothing is cached.
+    """
+    try:
+        with get_store().open(f"{file_name}{REQUESTS_SUFFIX}") as file:
+            if file is None:
+                raise FileNotFoundError(file_name)
+            n = array("q")
+            n.fromfile(file, 1)
+            doc_ids = array("q")
+            doc_ids.fromfile(file, n[0])
+            offsets = array("q")
+            offsets.fromfile(file, n[0] + 1)
+
+            num_docs = len(doc_ids) if max_doc_id is None else bisect.bisect_left(doc_ids, max_doc_id)
+            data = file.read(offsets[num_docs])
+    except Exception:
+        eval_logger.debug(f"{file_name} is not cached, generating...")
+        return None
+
+    doc_requests = []
+    for line in data.splitlines():
+        doc_id, requests = json.loads(line)
+        doc_requests.append(
+            (doc_id, [(idx, request_type, arguments) for idx, request_type, arguments in requests])
+        )
+    return doc_requests
+
+
+def save_dataset_to_cache(file_name, dataset) -> None:
+    """Stores a `datasets.Dataset` as an Arrow stream that can be memory-mapped on load."""
+    import pyarrow as pa
+
+    eval_logger.debug(f"Saving {file_name} to cache...")
+    if dataset._indices is not None:
+        # e.g. after `filter` or `select`, only store the selected rows
+        dataset = dataset.flatten_indices()
+    table = dataset.data.table
+    with get_store().writer(f"{file_name}{DATASET_SUFFIX}") as file:
+        with pa.ipc.new_stream(file, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_dataset_from_cache(file_name, fingerprint: Optional[str] = None):
+    """Loads a dataset saved by `save_dataset_to_cache`, memory-mapped, or returns None."""
+    import datasets
+    from datasets.table import MemoryMappedTable
+
+    store = get_store()
+    key = f"{file_name}{DATASET_SUFFIX}"
+    try:
+        with store.open(key) as file:
+            if file is None:
+                raise FileNotFoundError(file_name)
+        table = MemoryMappedTable.from_file(store.path(key))
+        return datasets.Dataset(table, fingerprint=fingerprint)
+    except Exception:
+        eval_logger.debug(f"{file_name} is not cached, generating...")
+        return None
+
+
 # NOTE the "key" param is to allow for flexibility
 def delete_cache(key: str = ""):
-    files = os.listdir(PATH)
-
-    for file in files:
-        if file.startswith(key) and file.endswith(FILE_SUFFIX):
-            file_path = f"{PATH}/{file}"
-            os.unlink(file_path)
+    """Deletes cached requests whose key starts with `key`, keeping all other entries."""
+    store = get_store()
+    for entry_key, _, _ in store.entries(prefix=key):
+        if entry_key.endswith((FILE_SUFFIX, REQUESTS_SUFFIX)):
+            store.delete(entry_key)
@@ -0,0 +1,118 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lm_tournament_eval.caching.cache import get_store
+from lm_tournament_eval.utils import eval_logger
+
+
+# bump when the layout of token cache entries changes
+TOKEN_CACHE_VERSION = 1
+
+
+class TokenCache:
+    """
+    Context and continuation token ids of the (context, continuation) pairs of a
+    task, for one tokenizer. Entries are laid out as flat arrays that are
+    memory-mapped on load:
+
+        int64[3]        version, number of pairs n, number of tokens
+        uint64[n]       sorted 64-bit hashes of the pairs
+        int64[2n + 1]   offsets, pair i has context tokens[offsets[2i]:offsets[2i + 1]]
+                        and continuation tokens[offsets[2i + 1]:offsets[2i + 2]]
+        int32[...]      tokens
+
+    New pairs are collected with `add` and merged into the entry by `save`.
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.new_pairs: Dict[int, Tuple[List[int], List[int]]] = {}
+        self.hashes, self.offsets, self.tokens = self._read()
+
+    @staticmethod
+    def pair_hash(context: str, continuation: str) -> int:
+        digest = hashlib.blake2b(
+            f"{context}\0{continuation}".encode("utf-8"), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    def _read(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        store = get_store()
+        empty = (np.zeros(0, np.uint64), np.zeros(1, np.int64), np.zeros(0, np.int32))
+        try:
+            with store.open(self.key) as file:
+                if file is None:
+                    return empty
+                header = np.frombuffer(file.read(24), dtype=np.int64)
+            version, num_pairs, num_tokens = (int(x) for x in header)
+            if version != TOKEN_CACHE_VERSION:
+                return empty
+
+            path = store.path(self.key)
+            offset = 24
+            hashes = np.memmap(path, dtype=np.uint64, mode="r", offset=offset, shape=(num_pairs,))
+            offset += 8 * num_pairs
+            offsets = np.memmap(path, dtype=np.int64, mode="r", offset=offset, shape=(2 * num_pairs + 1,))
+            offset += 8 * (2 * num_pairs + 1)
+            tokens = (
+                np.memmap(path, dtype=np.int32, mode="r", offset=offset, shape=(num_tokens,))
+                if num_tokens
+                else empty[2]
+            )
+            return hashes, offsets, tokens
+        except (OSError, ValueError) as e:
+            eval_logger.debug(f"Could not read token cache {self.key}: {e}")
+            return empty
+
+    def get(self, pair_hash: int) -> Optional[Tuple[List[int], List[int]]]:
+        i = int(np.searchsorted(self.hashes, np.uint64(pair_hash)))
+        if i < len(self.hashes) and int(self.hashes[i]) == pair_hash:
+            start, mid, end = self.offsets[2 * i : 2 * i + 3]
+            return self.tokens[start:mid].tolist(), self.tokens[mid:end].tolist()
+        return self.new_pairs.get(pair_hash)
+
+    def add(self, pair_hash: int, context_enc: List[int], continuation_enc: List[int]) -> None:
+        self.new_pairs[pair_hash] = (context_enc, continuation_enc)
+
+    def save(self) -> None:
+        """Merges the new pairs into the cache entry, if there are any."""
+        if not self.new_pairs:
+            return
+        store = get_store()
+        try:
+            with store.writer(self.key) as file:
+                # re-read under the writer lock to keep pairs saved by other processes
+                hashes, offsets, tokens = self._read()
+                pairs = {int(h): (i, None) for i, h in enumerate(hashes)}
+                for h, encs in self.new_pairs.items():
+                    pairs.setdefault(h, (None, encs))
+
+                order = sorted(pairs)
+                new_offsets = np.zeros(2 * len(order) + 1, dtype=np.int64)
+                chunks = []
+                position = 0
+                for j, h in enumerate(order):
+                    i, encs = pairs[h]
+                    if encs is None:
+                        start, mid, end = offsets[2 * i : 2 * i + 3]
+                        encs = (tokens[start:mid], tokens[mid:end])
+                    for k, enc in enumerate(encs):
+                        chunks.append(np.asarray(enc, dtype=np.int32))
+                        position += len(enc)
+                        new_offsets[2 * j + k + 1] = position
+
+                file.write(
+                    np.array([TOKEN_CACHE_VERSION, len(order), position], dtype=np.int64).tobytes()
+                )
+                file.write(np.array(order, dtype=np.uint64).tobytes())
+                file.write(new_offsets.tobytes())
+                if chunks:
+                    file.write(np.concatenate(chunks).tobytes())
+        except OSError as e:
+            eval_logger.debug(f"Could not save token cache {self.key}: {e}")
+            return
+        eval_logger.debug(f"Saved {len(self.new_pairs)} new pairs to token cache {self.key}")
+        self.new_pairs = {}
+        self.hashes, self.offsets, self.tokens = self._read()
@@ -211,7 +211,8 @@ def print_writeout(task) -> None:
 def get_sample_size(task, limit: Optional[int]) -> Union[int, None]:
     if limit is not None:
         limit = (
-            int(math.ceil(len(task.eval_docs) * limit)) if limit < 1.0 else int(limit)
+            # a fraction of the whole split, even if an eval limit was already set
+            int(math.ceil(task.num_eval_docs() * limit)) if limit < 1.0 else int(limit)
         )
     return limit
 
@@ -1,3 +1,6 @@
-from . import (
-    huggingface_model
-)
\ No newline at end of file
+from lm_tournament_eval.api.registry import register_lazy_model
+
+# backends are imported by `get_model` the first time they are used
+register_lazy_model(
+    "lm_tournament_eval.models.huggingface_model:HFLM", "hf-auto", "hf", "huggingface"
+)
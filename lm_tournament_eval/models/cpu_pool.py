@@ -0,0 +1,213 @@
+'''
+Data-parallel evaluation on CPU without torch.distributed or accelerate.
+
+`CPUWorkerPool` forks worker processes from a process that has already loaded
+an LM. The model weights are moved to shared memory before forking, so all
+workers use the same copy. Each worker is pinned to a set of cores of a single
+NUMA node and pulls request chunks from a shared queue, so faster workers
+simply take more chunks.
+'''
+
+import glob
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import re
+import weakref
+from typing import List
+
+from tqdm import tqdm
+
+from lm_tournament_eval.api.instance import Instance
+
+
+def _parse_cpulist(cpulist: str) -> List[int]:
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_numa_cpu_sets() -> List[List[int]]:
+    '''
+    Returns the cores available to this process, grouped by NUMA node.
+    '''
+    available = set(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count() or 1))
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in available]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+
+def plan_worker_cpu_sets(num_workers: int) -> List[List[int]]:
+    '''
+    Assigns each worker a disjoint set of cores within one NUMA node. Workers are
+    spread over the nodes round robin, and each node's cores are split evenly
+    between the workers placed on it.
+    '''
+    nodes = get_numa_cpu_sets()
+    workers_per_node = [0] * len(nodes)
+    for i in range(num_workers):
+        workers_per_node[i % len(nodes)] += 1
+
+    cpu_sets = []
+    for cpus, n in zip(nodes, workers_per_node):
+        if n == 0:
+            continue
+        per_worker = max(1, len(cpus) // n)
+        for j in range(n):
+            # with more workers than cores, workers share the node's last core
+            start = min(j * per_worker, len(cpus) - 1)
+            end = len(cpus) if j == n - 1 else start + per_worker
+            cpu_sets.append(cpus[start:end])
+    return cpu_sets
+
+
+# the LM the workers were forked from, set before the workers are started
+_worker_lm = None
+
+
+def _worker_main(task_queue, result_queue, cpus: List[int]) -> None:
+    import torch
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+    lm = _worker_lm
+    # requests sent to a worker must be run locally
+    lm.cpu_pool = None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        chunk_id, method, request_type, all_args = task
+        try:
+            requests = [
+                Instance(request_type=request_type, doc=None, arguments=args, idx=0)
+                for args in all_args
+            ]
+            result_queue.put((chunk_id, getattr(lm, method)(requests, disable_tqdm=True), None))
+        except Exception as e:
+            result_queue.put((chunk_id, None, repr(e)))
+
+
+def _shutdown_workers(task_queue, workers, timeout: float = 30) -> None:
+    for _ in workers:
+        task_queue.put(None)
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+
+
+class CPUWorkerPool:
+    '''
+    Runs LM requests on `num_workers` forked copies of `lm` and returns the
+    results in request order.
+    '''
+
+    # number of chunks per worker a call is split into, for load balancing
+    CHUNKS_PER_WORKER = 8
+    # seconds between checks that all workers are still alive while waiting for results
+    POLL_INTERVAL = 5.0
+
+    def __init__(self, lm, num_workers: int) -> None:
+        global _worker_lm
+
+        model = getattr(lm, "model", None)
+        if model is not None:
+            # weights in shared memory are not copied on write after the fork
+            model.share_memory()
+
+        # fork before the parent runs any forward pass, since OpenMP thread pools
+        # do not survive a fork
+        ctx = multiprocessing.get_context("fork")
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.cpu_sets = plan_worker_cpu_sets(num_workers)
+
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        _worker_lm = lm
+        self.workers = []
+        for cpus in self.cpu_sets:
+            worker = ctx.Process(
+                target=_worker_main,
+                args=(self.task_queue, self.result_queue, cpus),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        _worker_lm = None
+        # shut the workers down if the pool is garbage collected without `close`
+        self._finalizer = weakref.finalize(self, _shutdown_workers, self.task_queue, self.workers)
+
+        logging.info(
+            f"Started {len(self.workers)} CPU workers on cores "
+            + "; ".join(f"{cpus[0]}-{cpus[-1]}" for cpus in self.cpu_sets)
+        )
+
+    def run(self, method: str, request_type: str, requests, disable_tqdm: bool = False) -> list:
+        all_args = [req.args for req in requests]
+        if not all_args:
+            return []
+
+        # longest requests first, so the last chunks to finish are short ones
+        order = sorted(
+            range(len(all_args)),
+            key=lambda i: -sum(len(str(arg)) for arg in all_args[i]),
+        )
+        chunk_size = max(1, math.ceil(len(order) / (len(self.workers) * self.CHUNKS_PER_WORKER)))
+        chunks = [order[i : i + chunk_size] for i in range(0, len(order), chunk_size)]
+        for chunk_id, chunk in enumerate(chunks):
+            self.task_queue.put((chunk_id, method, request_type, [all_args[i] for i in chunk]))
+
+        res = [None] * len(all_args)
+        errors = []
+        pbar = tqdm(total=len(all_args), disable=disable_tqdm, desc=f"Running {method} requests")
+        # always drain all chunks, so that a failure does not leave stale results queued
+        for _ in range(len(chunks)):
+            chunk_id, results, error = self._get_result()
+            if error is not None:
+                errors.append(error)
+                continue
+            for i, result in zip(chunks[chunk_id], results):
+                res[i] = result
+            pbar.update(len(chunks[chunk_id]))
+        pbar.close()
+
+        if errors:
+            raise RuntimeError(f"CPU worker failed on {method}: {errors[0]}")
+        return res
+
+    def _get_result(self):
+        # a worker killed by the OS (e.g. out of memory) never sends its result
+        while True:
+            try:
+                return self.result_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                dead = [w for w in self.workers if not w.is_alive()]
+                if dead:
+                    # the chunks of the dead worker are lost, stop the others too
+                    for worker in self.workers:
+                        if worker.is_alive():
+                            worker.terminate()
+                    raise RuntimeError(
+                        f"CPU worker {dead[0].pid} died with exit code {dead[0].exitcode}"
+                    )
+
+    def close(self) -> None:
+        self._finalizer()
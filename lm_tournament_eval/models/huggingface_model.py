@@ -1,4 +1,4 @@
-from lm_tournament_eval.api.model import LM
+from lm_tournament_eval.api.model import LM, is_deterministic
 
 import torch
 import torch.nn.functional as F
@@ -14,7 +14,10 @@ from accelerate import (
     find_executable_batch_size,
 )
 from accelerate.utils import get_max_memory
+import collections
 import copy
+import itertools
+import json
 
 from huggingface_hub import HfApi
 
@@ -24,7 +27,16 @@ from ..api.lm_utils import (
     configure_pad_token,
     pad_and_concat,
     stop_sequences_criteria,
-    get_batches
+    get_batches,
+    get_batches_by_token_budget,
+    tokenizers_match,
+    pack_sequences,
+    make_packed_attention_mask,
+    make_packed_position_ids,
+    BatchPrefetcher,
+    PrefixKVCache,
+    longest_common_prefix,
+    tokenizer_fingerprint
 )
 
 from tqdm import tqdm
@@ -69,6 +81,13 @@ class HFLM(LM):
         max_memory_per_gpu: Optional[Union[int, str]] = None,
         max_cpu_memory: Optional[Union[int, str]] = None,
         offload_folder: Optional[Union[str, os.PathLike]] = "./offload",
+        packed: Optional[bool] = False,
+        max_batch_tokens: Optional[Union[int, str]] = None,
+        prefetch_batches: Optional[int] = 2,
+        prefix_cache_mb: Optional[int] = 0,
+        prefix_cache_min_tokens: Optional[int] = 32,
+        cpu_workers: Optional[int] = None,
+        token_cache: Optional[bool] = False,
         **kwargs,                 
     ) -> None:
         super().__init__()
@@ -136,7 +155,31 @@ class HFLM(LM):
         self.add_bos_token = add_bos_token
         self.custom_prefix_token_id = prefix_token_id
         self.batch_size_per_gpu = batch_size
+        self.max_batch_size = max_batch_size
         self.truncation = truncation
+        # token budget (batch size x padded length) per batch. "auto" probes
+        # device memory on first use. batch_size="auto" implies a probed budget,
+        # with max_batch_size capping the number of requests per batch.
+        if str(batch_size) == "auto":
+            self.batch_size_per_gpu = max_batch_size
+            max_batch_tokens = max_batch_tokens or "auto"
+        self.max_batch_tokens = max_batch_tokens
+        # number of loglikelihood batches staged ahead on a background thread, 0 disables
+        self.prefetch_batches = prefetch_batches
+        # past key/values of shared context prefixes (e.g. few-shot examples),
+        # reused across batches. 0 disables the cache.
+        self.prefix_cache = PrefixKVCache(prefix_cache_mb * 2**20) if prefix_cache_mb else None
+        self.prefix_cache_min_tokens = prefix_cache_min_tokens
+        # pack several loglikelihood requests into each row instead of padding
+        self.packed = packed
+        # draft model for assisted decoding, see `set_assistant_model`
+        self.assistant_model = None
+        # data-parallel worker processes when running on CPU, see `cpu_pool.py`
+        self.cpu_pool = None
+        # reuse token ids of loglikelihood requests across runs, see `attach_token_cache`
+        self.token_cache = token_cache
+        self._token_caches = {}
+        self._tokenizer_fingerprint = None
 
         # get backend
         self._get_backend()
@@ -152,6 +195,10 @@ class HFLM(LM):
             self._create_model(model, dtype=dtype, device=device, parallelize=parallelize, **kwargs)
 
         self.tokenizer = configure_pad_token(self.tokenizer)
+        # staged batches are pinned so host-to-device copies can overlap compute
+        self._pin_memory = (
+            torch.cuda.is_available() and torch.device(self.device).type == "cuda"
+        )
         if isinstance(model, str):
             if gpus >= 1 or str(self.device) == "mps":
                 # TODO: can remove this whole snippet except in the mps case, perhaps?
@@ -201,6 +248,18 @@ class HFLM(LM):
             self._rank = 0
             self._world_size = 1
 
+        if cpu_workers is not None and int(cpu_workers) > 1:
+            if torch.device(self.device).type != "cpu" or self.world_size > 1:
+                logging.warning("cpu_workers is only supported for single-process CPU runs, ignoring it.")
+            else:
+                from lm_tournament_eval.models.cpu_pool import CPUWorkerPool
+
+                self.cpu_pool = CPUWorkerPool(self, int(cpu_workers))
+
+    def close(self) -> None:
+        if self.cpu_pool is not None:
+            self.cpu_pool.close()
+            self.cpu_pool = None
 
     def _get_accelerate_args(self,
         parallelize: bool = None,
@@ -421,6 +480,70 @@ class HFLM(LM):
     def device(self):
         return self._device
 
+    def _detect_max_batch_tokens(self) -> int:
+        '''
+        Finds the largest batch of `max_length` sequences that fits in memory
+        and returns its size in tokens.
+        '''
+        max_length = self.max_length
+
+        @find_executable_batch_size(starting_batch_size=self.max_batch_size)
+        def forward_batch(batch_size):
+            test_batch = torch.ones((batch_size, max_length), device=self.device).long()
+            for _ in range(5):
+                F.log_softmax(self._model_call(test_batch), dim=-1)
+            return batch_size
+
+        batch_size = forward_batch()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        logging.info(f"Detected a token budget of {batch_size * max_length} tokens per batch")
+        return batch_size * max_length
+
+    @property
+    def token_budget(self) -> Optional[int]:
+        if self.max_batch_tokens == "auto":
+            self.max_batch_tokens = self._detect_max_batch_tokens()
+        return self.max_batch_tokens
+
+    def _get_batch_indices(self, lengths: List[int]):
+        '''
+        Batches request indices by token budget when one is set, otherwise into
+        fixed groups of `batch_size` requests in their original order.
+        '''
+        if self.token_budget is None:
+            return get_batches(list(range(len(lengths))), n=self.batch_size)
+        return get_batches_by_token_budget(
+            lengths, self.token_budget, max_batch_size=self.batch_size
+        )
+
+    def set_assistant_model(self, assistant: Optional["HFLM"]) -> bool:
+        '''
+        Use `assistant` as the draft model for assisted (speculative) decoding in
+        `generate_until`. The draft model must share this model's tokenizer. Greedy
+        generations are verified token-by-token by this model, so outputs are the
+        same as without an assistant. Passing None disables assisted decoding.
+
+        Returns True if the assistant was attached.
+        '''
+        if assistant is None:
+            self.assistant_model = None
+            return True
+
+        if not tokenizers_match(self.tokenizer, assistant.tokenizer):
+            logging.warning(
+                "Assistant model does not share a tokenizer with the target model, not using assisted decoding."
+            )
+            return False
+
+        if self.AUTO_MODEL_CLASS != transformers.AutoModelForCausalLM:
+            logging.warning("Assisted decoding is only supported for causal models.")
+            return False
+
+        self.assistant_model = assistant
+        return True
+
     def tok_encode(self, string: str, left_truncate_len=None, add_special_tokens=None):
         special_tokens_kwargs = {}
 
@@ -464,24 +587,73 @@ class HFLM(LM):
         '''
         requests is a list of (context, continuation) pairs
         '''
+        if self.cpu_pool is not None:
+            return self.cpu_pool.run("loglikelihood", "loglikelihood", requests, disable_tqdm=disable_tqdm)
+
         new_reqs = []
-        for context, continuation in [req.args for req in requests]:
-            if context == '':
+        for req in requests:
+            context, continuation = req.args
+            token_cache = self._token_caches.get(req.task_name)
+            cached = None
+            if token_cache is not None:
+                pair_hash = token_cache.pair_hash(context, continuation)
+                cached = token_cache.get(pair_hash)
+
+            if cached is not None:
+                context_enc, continuation_enc = cached
+            elif context == '':
                 context_enc, continuation_enc = (
                     [self.prefix_token_id],
                     self.tok_encode(continuation)
                 )
             else:
                 context_enc, continuation_enc = self._encode_pair(context, continuation)
+            if token_cache is not None and cached is None:
+                token_cache.add(pair_hash, context_enc, continuation_enc)
 
             new_reqs.append(((context, continuation), context_enc, continuation_enc))
 
         return self._loglikelihood_tokens(new_reqs)
 
-    def _model_call(self, inps, attn_mask=None, labels=None):
+    def attach_token_cache(self, task_keys: dict) -> None:
+        '''
+        Looks the token ids of loglikelihood requests up in a pre-tokenized cache per
+        task (task name -> key of the task config), and adds newly tokenized requests
+        to it (saved by `save_token_caches`). Caches are keyed by the tokenizer and the special tokens it adds.
+        '''
+        if not self.token_cache:
+            return
+        from lm_tournament_eval.caching.token_cache import TokenCache
+
+        if self._tokenizer_fingerprint is None:
+            self._tokenizer_fingerprint = tokenizer_fingerprint(self.tokenizer)[:16]
+        encoding = (
+            f"{self._tokenizer_fingerprint}-{self.AUTO_MODEL_CLASS.__name__}"
+            f"-bos{int(bool(self.add_bos_token))}-prefix{self.prefix_token_id}"
+        )
+        self._token_caches = {
+            task_name: TokenCache(f"tokens-{task_key}-{encoding}")
+            for task_name, task_key in task_keys.items()
+        }
+
+    def save_token_caches(self) -> None:
+        '''
+        Merges the requests tokenized since the last save into the token caches.
+        Each save rewrites the cache entries, so this is called once per evaluation
+        rather than per `loglikelihood` call.
+        '''
+        for token_cache in self._token_caches.values():
+            token_cache.save()
+
+    def _model_call(self, inps, attn_mask=None, labels=None, position_ids=None, past_key_values=None):
         with torch.no_grad():
             assert self.AUTO_MODEL_CLASS == transformers.AutoModelForCausalLM
-            return self.model(inps).logits
+            return self.model(
+                inps,
+                attention_mask=attn_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+            ).logits
         
     def _select_cont_toks(self, logits: torch.Tensor, contlen:int = None, inplen: int = None):
         assert (contlen and inplen)
@@ -490,86 +662,279 @@ class HFLM(LM):
         return logits
 
     def _loglikelihood_tokens(self, requests, disable_tqdm : bool = False) -> List[float]:
-        res = []
+        if self.packed:
+            return self._loglikelihood_tokens_packed(requests, disable_tqdm=disable_tqdm)
+
+        lengths = []
+        for _, context_enc, continuation_enc in requests:
+            assert len(context_enc) > 0
+            assert len(continuation_enc) > 0
+            assert len(continuation_enc) <= self.max_length
+            lengths.append(min(len(context_enc) + len(continuation_enc) - 1, self.max_length))
+
+        def prepare(chunk_indices):
+            # we assume we're in the causal case
+            padding_len_inp = max(lengths[i] for i in chunk_indices)
+            segments = [(i, row, 0, lengths[i]) for row, i in enumerate(chunk_indices)]
+            batched_inps = torch.zeros(len(chunk_indices), padding_len_inp, dtype=torch.long)
+            inps = []
+            for i, row, _, inplen in segments:
+                _, context_enc, continuation_enc = requests[i]
+                inps.append((context_enc+continuation_enc)[-(self.max_length + 1):][:-1])
+                batched_inps[row, :inplen] = torch.tensor(inps[-1], dtype=torch.long)
+            staged = self._stage_loglikelihood_batch(requests, batched_inps, segments)
+
+            if self.prefix_cache is not None:
+                # the prefix must end before the first scored position of every request
+                max_prefix_len = min(
+                    inplen - len(requests[i][2]) for i, _, _, inplen in segments
+                )
+                prefix = longest_common_prefix(inps)[:max_prefix_len]
+                if len(prefix) >= self.prefix_cache_min_tokens:
+                    staged["prefix"] = tuple(prefix)
+            return staged
+
+        call_kwargs_fn = None
+        if self.prefix_cache is not None:
+            call_kwargs_fn = self._prefix_call_kwargs
+
+        return self._run_loglikelihood_batches(
+            requests,
+            self._get_batch_indices(lengths),
+            prepare,
+            disable_tqdm=disable_tqdm,
+            call_kwargs_fn=call_kwargs_fn,
+        )
 
-        batch_size = self.batch_size
-        chunks = get_batches(requests, n=batch_size)
+    def _compute_prefix_kv(self, tokens, past_key_values=None, past_len: int = 0):
+        '''
+        Runs `tokens[past_len:]` through the model on top of the cached past
+        key/values of `tokens[:past_len]` and returns the per-layer (key, value)
+        tensors of all of `tokens`.
+        '''
+        inps = torch.tensor([tokens[past_len:]], dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            out = self.model(
+                inps,
+                past_key_values=self._expand_past_key_values(past_key_values, 1)
+                if past_key_values is not None
+                else None,
+                use_cache=True,
+            )
+        return self._past_key_value_tensors(out.past_key_values)
 
-        pbar = tqdm(
-            total=len(requests),
-            disable=disable_tqdm,
-            desc="Running loglikelihood requests",
-        )
+    @staticmethod
+    def _past_key_value_tensors(past_key_values) -> tuple:
+        '''
+        Returns the per-layer (key, value) tensors of a `Cache` object, whose layout
+        differs between transformers versions, or of legacy past key/values.
+        '''
+        if hasattr(past_key_values, "layers"):
+            return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+        if hasattr(past_key_values, "key_cache"):
+            return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+        return tuple((k, v) for k, v in past_key_values)
+
+    @staticmethod
+    def _expand_past_key_values(past_key_values, batch_size: int):
+        # expanded views are never written to: the model concatenates new keys/values
+        expanded = [
+            (k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+            for k, v in past_key_values
+        ]
+        if not hasattr(transformers, "DynamicCache"):
+            return tuple(expanded)
+        cache = transformers.DynamicCache()
+        for layer_idx, (k, v) in enumerate(expanded):
+            cache.update(k, v, layer_idx)
+        return cache
+
+    def _prefix_call_kwargs(self, staged) -> dict:
+        '''
+        Looks up (or computes and caches) the past key/values of the batch's shared
+        prefix, so that the forward pass only runs over the remaining tokens.
+        '''
+        prefix = staged.get("prefix")
+        if prefix is None:
+            return {}
+
+        key, past_key_values = self.prefix_cache.lookup(prefix)
+        if key is None or len(prefix) - len(key) >= self.prefix_cache_min_tokens:
+            # extend the longest cached prefix (if any) up to the full shared prefix
+            past_key_values = self._compute_prefix_kv(
+                prefix, past_key_values, past_len=len(key) if key is not None else 0
+            )
+            key = prefix
+            self.prefix_cache.insert(key, past_key_values)
 
-        for chunk in chunks:
-            inps = []
-            cont_toks_list = []
-            inplens = []
+        staged["prefix_len"] = len(key)
+        return {
+            "past_key_values": self._expand_past_key_values(
+                past_key_values, staged["inps"].shape[0]
+            )
+        }
 
-            conts = []
-            encoder_attns = []
+    def _stage_loglikelihood_batch(self, requests, batched_inps, segments) -> dict:
+        '''
+        Host-side part of a loglikelihood batch: collects the continuation tokens of
+        every segment `(request index, row, offset, inplen)` into one flat tensor and
+        pins the CPU tensors so they can be copied to the device asynchronously.
+        '''
+        cont_toks = [tok for i, *_ in segments for tok in requests[i][2]]
+        staged = {
+            "inps": batched_inps,
+            "cont_toks": torch.tensor(cont_toks, dtype=torch.long),
+            "segments": segments,
+        }
+        if self._pin_memory:
+            staged["inps"] = staged["inps"].pin_memory()
+            staged["cont_toks"] = staged["cont_toks"].pin_memory()
+        return staged
 
-            padding_len_inp = None
-            padding_len_cont = None
+    def _score_loglikelihood_batch(self, requests, staged, **call_kwargs):
+        '''
+        Device-side part of a loglikelihood batch. Returns the request indices with
+        the summed continuation logprobs and greedy flags as device tensors, so the
+        host does not wait on the device until the results are collected.
+        '''
+        # tokens covered by cached prefix key/values are not run through the model
+        prefix_len = staged.get("prefix_len", 0)
+        batched_inps = staged["inps"][:, prefix_len:].to(self.device, non_blocking=True)
+        cont_toks_flat = staged["cont_toks"].to(self.device, non_blocking=True)
 
-            for _, context_enc, continuation_enc in chunk:
-                assert len(context_enc) > 0
-                assert len(continuation_enc) > 0
-                assert len(continuation_enc) <= self.max_length
+        multi_logits = F.log_softmax(
+            self._model_call(batched_inps, **call_kwargs), dim=-1
+        )
 
-                # we assume we're in the causal case
-                inp = torch.tensor(
-                    (context_enc+continuation_enc)[-(self.max_length + 1):][:-1],
-                    dtype=torch.long,
-                    device=self.device
-                )
-                (inplen,) = inp.shape
+        indices = []
+        lls = []
+        greedy = []
+        cont_start = 0
+        for i, row, offset, inplen in staged["segments"]:
+            contlen = len(requests[i][2])
+            logits = self._select_cont_toks(
+                multi_logits[row, offset : offset + inplen - prefix_len],
+                contlen=contlen,
+                inplen=inplen - prefix_len,
+            )
+            logits = logits.unsqueeze(0)
 
-                padding_len_inp = (
-                    max(padding_len_inp, inplen)
-                    if padding_len_inp is not None
-                    else inplen
-                )
-                inps.append(inp)
-                cont_toks_list.append(continuation_enc)
-                inplens.append(inplen)
+            greedy_tokens = logits.argmax(dim=-1)
+            cont_toks = cont_toks_flat[cont_start : cont_start + contlen].unsqueeze(0)
+            cont_start += contlen
 
-            call_kwargs = {}
+            indices.append(i)
+            greedy.append((greedy_tokens == cont_toks).all())
+            lls.append(torch.gather(logits, 2, cont_toks.unsqueeze(-1)).squeeze(-1).sum())
 
-            batched_inps = pad_and_concat(
-                padding_len_inp, inps, padding_side="right"
-            )
+        return indices, torch.stack(lls), torch.stack(greedy)
 
-            multi_logits = F.log_softmax(
-                self._model_call(batched_inps, **call_kwargs), dim=-1
-            )
+    def _run_loglikelihood_batches(self, requests, batches, prepare_fn, disable_tqdm : bool = False, call_kwargs_fn=None) -> List[float]:
+        '''
+        Runs loglikelihood batches as a pipeline: `prepare_fn` stages upcoming batches
+        on a background thread while the current forward pass runs, and the results
+        of each batch are copied back to the host only after the next batch has been
+        launched.
+        '''
+        res = [None] * len(requests)
+        pbar = tqdm(
+            total=len(requests),
+            disable=disable_tqdm,
+            desc="Running loglikelihood requests",
+        )
 
-            for (request_str, ctx_tokens, _), logits, inplen, cont_toks in zip(
-                chunk, multi_logits, inplens, cont_toks_list
-            ):
-                contlen = len(cont_toks)
-                ctx_len = inplen + (logits.shape[0] - padding_len_inp)
-                logits = self._select_cont_toks(logits, contlen=contlen, inplen=ctx_len)
-                logits = logits.unsqueeze(0) 
-
-                greedy_tokens = logits.argmax(dim=-1)
-                
-                cont_toks = torch.tensor(cont_toks, dtype=torch.long, device=self.device).unsqueeze(0)
-                max_equal = (greedy_tokens == cont_toks).all()
-                
-                logits = torch.gather(logits, 2, cont_toks.unsqueeze(-1)).squeeze(-1)
-
-                answer = (float(logits.sum()), bool(max_equal))
-                res.append(answer)
-                pbar.update(1)
+        def collect(scored):
+            indices, lls, greedy = scored
+            for i, ll, max_equal in zip(indices, lls.tolist(), greedy.tolist()):
+                res[i] = (float(ll), bool(max_equal))
+            pbar.update(len(indices))
+
+        pending = None
+        for staged in BatchPrefetcher(batches, prepare_fn, depth=self.prefetch_batches):
+            call_kwargs = call_kwargs_fn(staged) if call_kwargs_fn is not None else {}
+            scored = self._score_loglikelihood_batch(requests, staged, **call_kwargs)
+            if pending is not None:
+                collect(pending)
+            pending = scored
+        if pending is not None:
+            collect(pending)
 
         pbar.close()
         return res
-            
+
+    def _loglikelihood_tokens_packed(self, requests, disable_tqdm : bool = False) -> List[float]:
+        '''
+        Padding-free variant of `_loglikelihood_tokens`. Requests are packed into rows
+        as long as the longest request, each segment gets its own position ids and a
+        block-diagonal causal mask, and logits are unpacked per segment afterwards.
+        '''
+        inplens = []
+        for _, context_enc, continuation_enc in requests:
+            assert len(context_enc) > 0
+            assert len(continuation_enc) > 0
+            assert len(continuation_enc) <= self.max_length
+            inplens.append(min(len(context_enc) + len(continuation_enc) - 1, self.max_length))
+
+        if not inplens:
+            return []
+
+        row_length = max(inplens)
+        rows = pack_sequences(inplens, row_length)
+
+        # flash attention derives the segment boundaries from the position ids alone
+        use_flash_attention = (
+            getattr(self.model.config, "_attn_implementation", None) == "flash_attention_2"
+        )
+
+        rows_per_batch = self.batch_size
+        if self.token_budget is not None:
+            rows_per_batch = max(1, self.token_budget // row_length)
+
+        def prepare(row_chunk):
+            segments = []
+            batched_inps = torch.zeros(len(row_chunk), row_length, dtype=torch.long)
+            for r, row in enumerate(row_chunk):
+                offset = 0
+                for i in row:
+                    _, context_enc, continuation_enc = requests[i]
+                    batched_inps[r, offset : offset + inplens[i]] = torch.tensor(
+                        (context_enc+continuation_enc)[-(self.max_length + 1):][:-1],
+                        dtype=torch.long,
+                    )
+                    segments.append((i, r, offset, inplens[i]))
+                    offset += inplens[i]
+            staged = self._stage_loglikelihood_batch(requests, batched_inps, segments)
+            staged["segment_lengths"] = [[inplens[i] for i in row] for row in row_chunk]
+            return staged
+
+        def call_kwargs(staged):
+            # built on the device, the dense masks are too large to stage on the host
+            segment_lengths = staged["segment_lengths"]
+            kwargs = {
+                "position_ids": make_packed_position_ids(segment_lengths, row_length, device=self.device)
+            }
+            if not use_flash_attention:
+                kwargs["attn_mask"] = make_packed_attention_mask(
+                    segment_lengths, row_length, dtype=self.model.dtype, device=self.device
+                )
+            return kwargs
+
+        return self._run_loglikelihood_batches(
+            requests,
+            get_batches(rows, n=rows_per_batch),
+            prepare,
+            disable_tqdm=disable_tqdm,
+            call_kwargs_fn=call_kwargs,
+        )
+
     def loglikelihood_rolling(self, requests : List[str], disable_tqdm : bool = False) -> List[Tuple[float]]:
         '''
         We will assume that `requests` has type List[str] for this implementation
         '''
+        if self.cpu_pool is not None:
+            return self.cpu_pool.run(
+                "loglikelihood_rolling", "loglikelihood_rolling", requests, disable_tqdm=disable_tqdm
+            )
         loglikelihoods = []
 
         for req in tqdm(requests, disable=disable_tqdm):
@@ -651,6 +1016,16 @@ class HFLM(LM):
         if do_sample is False and generation_kwargs.get("temperature") == 0.0:
             generation_kwargs.pop("temperature")
 
+        # assisted decoding only keeps outputs identical for greedy search,
+        # and transformers only supports it for a batch size of 1.
+        if (
+            self.assistant_model is not None
+            and do_sample is False
+            and generation_kwargs.get("num_beams", 1) == 1
+            and context.shape[0] == 1
+        ):
+            generation_kwargs["assistant_model"] = self.assistant_model.model
+
         stopping_criteria = stop_sequences_criteria(
             self.tokenizer, stop, context.shape[1], context.shape[0]
         )
@@ -664,8 +1039,48 @@ class HFLM(LM):
             **generation_kwargs
         )
 
+    def _uses_assistant(self, gen_kwargs) -> bool:
+        # see `_model_generate`: only greedy search is assisted
+        return (
+            self.assistant_model is not None
+            and isinstance(gen_kwargs, dict)
+            and is_deterministic("generate_until", (None, gen_kwargs))
+            and gen_kwargs.get("num_beams", 1) == 1
+        )
+
+    def _get_generate_batch_indices(self, all_args, indices: Optional[List[int]] = None):
+        '''
+        Batches generation requests (those at `indices`, or all) by token budget,
+        counting each request as its (truncated) context plus `max_gen_toks`. Requests
+        are grouped by their generation kwargs first, since a batch is generated with
+        a single set of kwargs.
+        '''
+        groups = collections.defaultdict(list)
+        for i in range(len(all_args)) if indices is None else indices:
+            gen_kwargs = all_args[i][1]
+            groups[json.dumps(gen_kwargs, sort_keys=True, default=str)].append(i)
+
+        for indices in groups.values():
+            gen_kwargs = all_args[indices[0]][1]
+            max_gen_toks = self.max_gen_toks
+            if isinstance(gen_kwargs, dict):
+                max_gen_toks = gen_kwargs.get("max_gen_toks", self.max_gen_toks)
+            lengths = [
+                min(len(self.tok_encode(all_args[i][0])), self.max_length - max_gen_toks)
+                + max_gen_toks
+                for i in indices
+            ]
+            for batch in get_batches_by_token_budget(
+                lengths, self.token_budget, max_batch_size=self.batch_size
+            ):
+                yield [indices[j] for j in batch]
+
     def generate_until(self, requests, disable_tqdm : bool = False) -> List[str]:
-        res = []
+        if self.cpu_pool is not None:
+            return self.cpu_pool.run("generate_until", "generate_until", requests, disable_tqdm=disable_tqdm)
+
+        all_args = [req.args for req in requests]
+        res = [None] * len(all_args)
 
         pbar = tqdm(
             total=len(requests),
@@ -673,10 +1088,17 @@ class HFLM(LM):
             desc="Running generate_until requests",
         )
 
-        batch_size = self.batch_size
+        # assisted decoding runs one request at a time, other requests are batched
+        assisted = [i for i, (_, gen_kwargs) in enumerate(all_args) if self._uses_assistant(gen_kwargs)]
+        batched = sorted(set(range(len(all_args))) - set(assisted))
+        if self.token_budget is not None:
+            batches = self._get_generate_batch_indices(all_args, batched)
+        else:
+            batches = get_batches(batched, n=self.batch_size)
+        chunks = itertools.chain(([i] for i in assisted), batches)
 
-        chunks = get_batches(requests, n=batch_size)
-        for chunk in chunks:
+        for chunk_indices in chunks:
+            chunk = [all_args[i] for i in chunk_indices]
             contexts, all_gen_kwargs = zip(*chunk)
             gen_kwargs = all_gen_kwargs[0]
             until = None
@@ -729,7 +1151,7 @@ class HFLM(LM):
             )
 
             cont_toks_list = cont.tolist()
-            for cont_toks, context in zip(cont_toks_list, contexts):
+            for i, cont_toks, context in zip(chunk_indices, cont_toks_list, contexts):
                 if self.AUTO_MODEL_CLASS == transformers.AutoModelForCausalLM:
                     cont_toks = cont_toks[context_enc.shape[1] : ]
 
@@ -739,7 +1161,7 @@ class HFLM(LM):
                     if len(term) > 0:
                         s = s.split(term)[0]
 
-                res.append(s)
+                res[i] = s
                 pbar.update(1)
         return res
     
@@ -0,0 +1,344 @@
+'''
+A long-lived local model server that keeps loaded models in memory between
+tournaments, and the `RemoteLM` client used by `load_model` to talk to it.
+
+The server listens on a Unix socket, by default in a runtime directory only
+the current user can access, and clients authenticate with a random key that
+the server writes next to the socket. It keeps a pool of LMs keyed by
+(model_type, model, model_args, load config). Models that are not in use are
+evicted least recently used first when the pool exceeds its memory budget, or
+once they have been idle for longer than `idle_timeout` seconds.
+'''
+
+import collections
+import gc
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import Any, List, Optional, Tuple
+
+from lm_tournament_eval.api.instance import Instance
+from lm_tournament_eval.api.model import LM
+
+
+# attributes of a served LM that clients may read, all plain scalars
+REMOTE_ATTRIBUTES = frozenset(
+    ["batch_size", "max_length", "max_gen_toks", "eot_token_id", "prefix_token_id", "token_budget"]
+)
+
+
+def _check_private(path: str) -> None:
+    '''
+    Raises a PermissionError unless `path` is owned by the current user and not
+    accessible by other users. Symlinks are not followed.
+    '''
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        raise PermissionError(f"{path} is a symlink")
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by another user")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"{path} is accessible by other users")
+
+
+def runtime_dir() -> str:
+    '''
+    Returns a directory only the current user can access, in `$XDG_RUNTIME_DIR`
+    or else the temp directory, creating it if needed.
+    '''
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    path = os.path.join(base, f"lm_tournament_eval_{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    _check_private(path)
+    return path
+
+
+def default_socket_path() -> str:
+    return os.path.join(runtime_dir(), "model_server.sock")
+
+
+def _authkey_path(socket_path: str) -> str:
+    return f"{socket_path}.key"
+
+
+def _read_authkey(socket_path: str) -> bytes:
+    key_path = _authkey_path(socket_path)
+    _check_private(key_path)
+    with open(key_path, "rb") as f:
+        return f.read()
+
+
+def _write_authkey(socket_path: str) -> bytes:
+    key_path = _authkey_path(socket_path)
+    if os.path.lexists(key_path):
+        os.remove(key_path)
+    authkey = os.urandom(32)
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+
+def connect_to_server(socket_path: str):
+    '''
+    Returns an authenticated connection to the model server listening on
+    `socket_path`, or None if there is none. The socket and its key file must be
+    owned by the current user, since replies from the server are unpickled.
+    '''
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        _check_private(socket_path)
+        authkey = _read_authkey(socket_path)
+        return Client(socket_path, family="AF_UNIX", authkey=authkey)
+    except (PermissionError, AuthenticationError) as e:
+        logging.warning(f"Not using the model server on {socket_path}: {e}")
+        return None
+    except (OSError, EOFError):
+        # no server listening, or it shut down during the handshake
+        return None
+
+
+class ModelServer:
+    '''
+    Serves `loglikelihood`, `loglikelihood_rolling` and `generate_until` calls for
+    a pool of loaded models. Calls are run one at a time, since all models share
+    the same device(s).
+    '''
+
+    def __init__(
+        self,
+        socket_path: Optional[str] = None,
+        memory_budget_gb: Optional[float] = None,
+        idle_timeout: Optional[float] = 3600,
+    ) -> None:
+        self.socket_path = socket_path or default_socket_path()
+        self.memory_budget = int(memory_budget_gb * 2**30) if memory_budget_gb else None
+        self.idle_timeout = idle_timeout
+
+        # key -> [lm, nbytes, last_used, active_clients], least recently used first
+        self.pool = collections.OrderedDict()
+        self.pool_lock = threading.Lock()
+        self.call_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.socket_path):
+            if connect_to_server(self.socket_path) is not None:
+                raise RuntimeError(f"A model server is already running on {self.socket_path}")
+            os.remove(self.socket_path)
+
+        # requests are pickled, so only clients holding the key may connect, and
+        # only the current user can read the key or connect to the socket
+        authkey = _write_authkey(self.socket_path)
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.socket_path, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+        logging.info(f"Model server listening on {self.socket_path}")
+
+        threading.Thread(target=self._evict_idle_loop, daemon=True).start()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    logging.warning("Rejected a model server client with a wrong key")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            for path in (self.socket_path, _authkey_path(self.socket_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+            logging.info("Model server stopped.")
+
+    def _handle(self, conn) -> None:
+        keys = []
+        try:
+            while True:
+                try:
+                    op, *args = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if op == "load":
+                        key, info = self._acquire(*args)
+                        keys.append(key)
+                        result = (key, info)
+                    elif op == "call":
+                        result = self._call(*args)
+                    elif op == "call_method":
+                        result = self._call_method(*args)
+                    elif op == "getattr":
+                        result = self._getattr(*args)
+                    elif op == "ping":
+                        result = [(key, entry[1]) for key, entry in self.pool.items()]
+                    elif op == "shutdown":
+                        self.stop_event.set()
+                        # wake up the accept() in serve_forever
+                        connect_to_server(self.socket_path)
+                        result = None
+                    else:
+                        raise ValueError(f"Unknown model server operation {op}")
+                    conn.send(("ok", result))
+                except AttributeError as e:
+                    # attribute probes from hasattr() on the client
+                    conn.send(("error", e))
+                except Exception as e:
+                    logging.exception(f"Model server operation {op} failed")
+                    conn.send(("error", e))
+        finally:
+            conn.close()
+            with self.pool_lock:
+                for key in keys:
+                    if key in self.pool:
+                        self.pool[key][3] -= 1
+                        self.pool[key][2] = time.monotonic()
+
+    def _acquire(self, model_type: str, model: str, model_args, load_kwargs: dict) -> Tuple[Any, dict]:
+        from lm_tournament_eval.api.model_utils import load_model
+
+        key = (model_type, model, repr(model_args), repr(sorted(load_kwargs.items())))
+        with self.pool_lock:
+            entry = self.pool.get(key)
+            if entry is not None:
+                logging.info(f"Reusing loaded model {model}")
+                self.pool.move_to_end(key)
+                entry[3] += 1
+                return key, self._describe(entry[0])
+
+        with self.call_lock:
+            lm = load_model(model_type, model, model_args, use_server=False, **load_kwargs)
+        nbytes = self._memory_footprint(lm)
+
+        with self.pool_lock:
+            self.pool[key] = [lm, nbytes, time.monotonic(), 1]
+            self._evict(over_budget_only=True)
+        return key, self._describe(lm)
+
+    def _call(self, key, method: str, request_type: str, all_args: List[tuple]):
+        lm = self.pool[key][0]
+        requests = [
+            Instance(request_type=request_type, doc=None, arguments=args, idx=0)
+            for args in all_args
+        ]
+        with self.call_lock:
+            return getattr(lm, method)(requests)
+
+    def _call_method(self, key, method: str):
+        with self.call_lock:
+            return getattr(self.pool[key][0], method)()
+
+    def _getattr(self, key, name: str):
+        if name not in REMOTE_ATTRIBUTES:
+            raise AttributeError(f"{name} is not available from the model server")
+        return getattr(self.pool[key][0], name)
+
+    @staticmethod
+    def _describe(lm: LM) -> dict:
+        return {"rank": lm.rank, "world_size": lm.world_size}
+
+    @staticmethod
+    def _memory_footprint(lm: LM) -> int:
+        model = getattr(lm, "model", None)
+        if hasattr(model, "get_memory_footprint"):
+            return model.get_memory_footprint()
+        if hasattr(model, "parameters"):
+            return sum(p.numel() * p.element_size() for p in model.parameters())
+        return 0
+
+    def _evict(self, over_budget_only: bool) -> None:
+        # called with pool_lock held; models in use by a client are never evicted
+        now = time.monotonic()
+        evicted = []
+        for key, (_, nbytes, last_used, active) in list(self.pool.items()):
+            if active > 0:
+                continue
+            if over_budget_only:
+                total = sum(entry[1] for entry in self.pool.values())
+                if self.memory_budget is None or total <= self.memory_budget:
+                    break
+            elif self.idle_timeout is None or now - last_used < self.idle_timeout:
+                continue
+            logging.info(f"Evicting model {key[1]} ({nbytes / 2**30:.2f} GiB)")
+            evicted.append(self.pool.pop(key))
+            evicted[-1][0].close()
+
+        if evicted:
+            del evicted
+            gc.collect()
+            try:
+                import torch
+
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+
+    def _evict_idle_loop(self) -> None:
+        while not self.stop_event.wait(60):
+            with self.pool_lock:
+                self._evict(over_budget_only=False)
+
+
+class RemoteLM(LM):
+    '''
+    An LM backed by a model loaded in a running `ModelServer`. Only the request
+    arguments are sent to the server; the scalar attributes in `REMOTE_ATTRIBUTES`
+    are fetched from the served LM on first access.
+    '''
+
+    def __init__(self, conn, model_type: str, model: str, model_args, load_kwargs: dict) -> None:
+        super().__init__()
+        self._conn = conn
+        self._key, info = self._request("load", model_type, model, model_args, load_kwargs)
+        self._rank = info["rank"]
+        self._world_size = info["world_size"]
+        self._attrs = {}
+
+    def _request(self, op: str, *args):
+        self._conn.send((op, *args))
+        status, result = self._conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def __getattr__(self, name: str):
+        # only called for attributes not set on the client
+        if name not in REMOTE_ATTRIBUTES:
+            raise AttributeError(name)
+        if name not in self._attrs:
+            self._attrs[name] = self._request("getattr", self._key, name)
+        return self._attrs[name]
+
+    def get_model_info(self) -> dict:
+        return self._request("call_method", self._key, "get_model_info")
+
+    def close(self) -> None:
+        # the server may evict the model once no client uses it
+        self._conn.close()
+
+    def loglikelihood(self, requests) -> List[Tuple[float, bool]]:
+        return self._request(
+            "call", self._key, "loglikelihood", "loglikelihood", [req.args for req in requests]
+        )
+
+    def loglikelihood_rolling(self, requests) -> List[Tuple[float]]:
+        return self._request(
+            "call", self._key, "loglikelihood_rolling", "loglikelihood_rolling",
+            [req.args for req in requests],
+        )
+
+    def generate_until(self, requests) -> List[str]:
+        return self._request(
+            "call", self._key, "generate_until", "generate_until", [req.args for req in requests]
+        )
@@ -1,19 +1,32 @@
+from __future__ import annotations
+
 import collections
 import inspect
+import json
 import logging
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Dict, List, Mapping, Optional, Union
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Union
 
 from lm_tournament_eval import utils
 from lm_tournament_eval.api.group import ConfigurableGroup, GroupConfig
-from lm_tournament_eval.api.task import ConfigurableTask, Task
-from lm_tournament_eval.evaluator_utils import get_subtask_list
+from lm_tournament_eval.caching.cache import get_store
+
+# tasks (and datasets, metrics, ...) are only imported once a task is loaded,
+# so that indexing and listing tasks stays fast
+if TYPE_CHECKING:
+    from lm_tournament_eval.api.task import Task
 
 
 GROUP_ONLY_KEYS = list(GroupConfig().to_dict().keys())
 
 
+# bump when the entries of the persisted task index change
+TASK_INDEX_VERSION = 1
+
+
 class TaskManager:
     """TaskManager indexes all tasks from the default `lm_eval/tasks/`
     and an optional directory if provided.
@@ -264,6 +277,8 @@ class TaskManager:
                     ),
                     **config,
                 }
+            from lm_tournament_eval.api.task import ConfigurableTask
+
             if self._config_is_python_task(config):
                 if self._class_has_config_in_constructor(config["class"]):
                     task_object = config["class"](config=config)
@@ -436,91 +451,160 @@ class TaskManager:
         :return
             Dictionary of task names as key and task metadata
         """
-        # TODO: remove group in next release
-        print_info = True
         ignore_dirs = [
             "__pycache__",
             ".ipynb_checkpoints",
         ]
-        tasks_and_groups = collections.defaultdict()
+        yaml_paths = []
         for root, dirs, file_list in os.walk(task_dir):
             dirs[:] = [d for d in dirs if d not in ignore_dirs]
             for f in file_list:
                 if f.endswith(".yaml"):
-                    yaml_path = os.path.join(root, f)
-                    config = utils.load_yaml_config(yaml_path, mode="simple")
-                    if self._config_is_python_task(config):
-                        # This is a python class config
-                        tasks_and_groups[config["task"]] = {
-                            "type": "python_task",
-                            "yaml_path": yaml_path,
-                        }
-                    elif self._config_is_group(config):
-                        # This is a group config
-                        tasks_and_groups[config["group"]] = {
-                            "type": "group",
-                            "task": -1,  # This signals that
-                            # we don't need to know
-                            # the task list for indexing
-                            # as it can be loaded
-                            # when called.
-                            "yaml_path": yaml_path,
-                        }
+                    yaml_paths.append(os.path.join(root, f))
+        file_index = self._index_yaml_files(task_dir, yaml_paths)
 
-                        # # Registered the level 1 tasks from a group config
-                        # for config in config["task"]:
-                        #     if isinstance(config, dict) and self._config_is_task(config):
-                        #         task = config["task"]
-                        #         tasks_and_groups[task] = {
-                        #             "type": "task",
-                        #             "yaml_path": yaml_path,
-                        #             }
-
-                    elif self._config_is_task(config):
-                        # This is a task config
-                        task = config["task"]
-                        tasks_and_groups[task] = {
-                            "type": "task",
-                            "yaml_path": yaml_path,
-                        }
+        tasks_and_groups = collections.defaultdict()
+        for yaml_path in yaml_paths:
+            entry = file_index[yaml_path]
+            if entry["type"] == "python_task":
+                # This is a python class config
+                tasks_and_groups[entry["name"]] = {
+                    "type": "python_task",
+                    "yaml_path": yaml_path,
+                }
+            elif entry["type"] == "group":
+                # This is a group config
+                tasks_and_groups[entry["name"]] = {
+                    "type": "group",
+                    "task": -1,  # This signals that
+                    # we don't need to know
+                    # the task list for indexing
+                    # as it can be loaded
+                    # when called.
+                    "yaml_path": yaml_path,
+                }
+            elif entry["type"] == "task":
+                # This is a task config
+                task = entry["name"]
+                tasks_and_groups[task] = {
+                    "type": "task",
+                    "yaml_path": yaml_path,
+                }
 
-                        # TODO: remove group in next release
-                        for attr in ["tag", "group"]:
-                            if attr in config:
-                                if attr == "group" and print_info:
-                                    #self.logger.info(
-                                    #    "`group` and `group_alias` keys in tasks' configs will no longer be used in the next release of lm-eval. "
-                                    #    "`tag` will be used to allow to call a collection of tasks just like `group`. "
-                                    #    "`group` will be removed in order to not cause confusion with the new ConfigurableGroup "
-                                    #    "which will be the offical way to create groups with addition of group-wide configuations."
-                                    #)
-                                    print_info = False
-                                    # attr = "tag"
-
-                                attr_list = config[attr]
-                                if isinstance(attr_list, str):
-                                    attr_list = [attr_list]
-
-                                for tag in attr_list:
-                                    if tag not in tasks_and_groups:
-                                        tasks_and_groups[tag] = {
-                                            "type": "tag",
-                                            "task": [task],
-                                            "yaml_path": -1,
-                                        }
-                                    elif tasks_and_groups[tag]["type"] != "tag":
-                                        self.logger.info(
-                                            f"The tag {tag} is already registered as a group, this tag will not be registered. "
-                                            "This may affect tasks you want to call."
-                                        )
-                                        break
-                                    else:
-                                        tasks_and_groups[tag]["task"].append(task)
-                    else:
-                        self.logger.debug(f"File {f} in {root} could not be loaded")
+                # TODO: remove group in next release
+                for _, attr_list in entry["tags"]:
+                    for tag in attr_list:
+                        if tag not in tasks_and_groups:
+                            tasks_and_groups[tag] = {
+                                "type": "tag",
+                                "task": [task],
+                                "yaml_path": -1,
+                            }
+                        elif tasks_and_groups[tag]["type"] != "tag":
+                            self.logger.info(
+                                f"The tag {tag} is already registered as a group, this tag will not be registered. "
+                                "This may affect tasks you want to call."
+                            )
+                            break
+                        else:
+                            tasks_and_groups[tag]["task"].append(task)
+            else:
+                self.logger.debug(f"File {yaml_path} could not be loaded")
 
         return tasks_and_groups
 
+    def _index_yaml_file(self, yaml_path: str) -> dict:
+        """Parses a task yaml into the entry `_get_task_and_group` indexes it by."""
+        # the signature is taken before parsing, so an edit during parsing is picked up next time
+        signature = _file_signature(yaml_path)
+        included_paths = []
+        config = utils.load_yaml_config(
+            yaml_path, mode="simple", included_paths=included_paths
+        )
+        entry = {
+            "files": [[yaml_path, signature]]
+            + [[path, _file_signature(path)] for path in included_paths],
+            "type": None,
+        }
+        if self._config_is_python_task(config):
+            entry.update(type="python_task", name=config["task"])
+        elif self._config_is_group(config):
+            entry.update(type="group", name=config["group"])
+        elif self._config_is_task(config):
+            tags = []
+            for attr in ["tag", "group"]:
+                if attr in config:
+                    attr_list = config[attr]
+                    if isinstance(attr_list, str):
+                        attr_list = [attr_list]
+                    tags.append([attr, list(attr_list)])
+            entry.update(type="task", name=config["task"], tags=tags)
+        return entry
+
+    def _index_yaml_files(self, task_dir: str, yaml_paths: List[str]) -> Dict[str, dict]:
+        """
+        Returns the index entry of every yaml in `yaml_paths`. Entries are persisted
+        in the cache, keyed by the mtime and size of the yaml and the files it
+        includes, and only yamls that changed since the last run are parsed again.
+        """
+        key = f"task_index-{os.path.abspath(task_dir)}"
+        cached = {}
+        try:
+            with get_store().open(key) as file:
+                if file is not None:
+                    cached = json.loads(file.read())
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.logger.debug(f"Could not read the task index of {task_dir}: {e}")
+        if cached.get("version") != TASK_INDEX_VERSION:
+            cached = {}
+        cached_entries = cached.get("entries", {})
+
+        signatures = {}
+
+        def _is_fresh(entry) -> bool:
+            for path, signature in entry["files"]:
+                if path not in signatures:
+                    signatures[path] = _file_signature(path)
+                if signatures[path] != signature:
+                    return False
+            return True
+
+        file_index = {}
+        stale_paths = []
+        for yaml_path in yaml_paths:
+            entry = cached_entries.get(yaml_path)
+            if entry is not None and _is_fresh(entry):
+                file_index[yaml_path] = entry
+            else:
+                stale_paths.append(yaml_path)
+
+        if stale_paths:
+            self.logger.debug(f"Indexing {len(stale_paths)} task yamls in {task_dir}")
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as pool:
+                for yaml_path, entry in zip(
+                    stale_paths, pool.map(self._index_yaml_file, stale_paths)
+                ):
+                    file_index[yaml_path] = entry
+
+        if stale_paths or len(file_index) != len(cached_entries):
+            try:
+                data = json.dumps({"version": TASK_INDEX_VERSION, "entries": file_index})
+                with get_store().writer(key) as file:
+                    file.write(data.encode("utf-8"))
+            except (OSError, TypeError, sqlite3.Error) as e:
+                # e.g. a read-only or locked cache directory or names that are not JSON serializable
+                self.logger.debug(f"Could not save the task index of {task_dir}: {e}")
+
+        return file_index
+
+
+def _file_signature(path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
 
 def get_task_name_from_config(task_config: Dict[str, str]) -> str:
     if "task" in task_config:
@@ -588,6 +672,8 @@ def get_task_dict(
     :return
         Dictionary of task objects
     """
+    from lm_tournament_eval.api.task import Task
+    from lm_tournament_eval.evaluator_utils import get_subtask_list
 
     task_name_from_string_dict = {}
     task_name_from_config_dict = {}
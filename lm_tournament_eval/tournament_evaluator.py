@@ -1,10 +1,12 @@
 import logging
-from typing import Optional
+from typing import Callable, List, Optional
 import json
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import itertools
+import numbers
 import torch
+from concurrent.futures import ThreadPoolExecutor
 
 import lm_tournament_eval.api.registry
 import lm_tournament_eval.api.metrics
@@ -12,7 +14,9 @@ import lm_tournament_eval.api.task
 from lm_tournament_eval.api.task import Task
 
 import lm_tournament_eval.models
-from lm_tournament_eval.api.model import LM
+from lm_tournament_eval.api.model import LM, is_deterministic
+from lm_tournament_eval.api.instance import Instance
+from lm_tournament_eval.api.lm_utils import BatchPrefetcher
 
 from lm_tournament_eval.utils import (
     eval_logger,
@@ -23,10 +27,291 @@ from lm_tournament_eval.utils import (
 from lm_tournament_eval.evaluator_utils import (
     consolidate_group_results,
     consolidate_results,
+    get_sample_size,
     get_subtask_list,
     prepare_print_tasks,
 )
 
+# minimal requests (a token or two) used to even out request counts across ranks. The
+# text is not whitespace, which some tokenizers encode to no tokens at all.
+SENTINEL_ARGUMENTS = {
+    "loglikelihood": ("", "a"),
+    "loglikelihood_rolling": ("a",),
+    "generate_until": ("a", {"until": [], "max_gen_toks": 1, "do_sample": False}),
+}
+
+
+def _request_key(reqtype: str, req) -> Optional[str]:
+    if not is_deterministic(reqtype, req.args):
+        return None
+    return json.dumps(req.args, sort_keys=True, default=str)
+
+
+def _metric_kind(values) -> Optional[str]:
+    # numeric metric lists are sent as float64 tensors and cast back afterwards
+    if all(isinstance(v, bool) for v in values):
+        return "bool"
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "int" if all(abs(v) < 2**53 for v in values) else None
+    if all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in values):
+        return "float"
+    return None
+
+
+def gather_task_outputs(eval_tasks, rank: int, world_size: int, device, log_samples: bool) -> None:
+    """Gathers `sample_metrics` (and `logged_samples`) of all tasks to rank 0.
+
+    Numeric metrics of all tasks are packed into one flat float64 tensor per rank and
+    gathered with a single tensor collective (plus one for the tensor lengths). Metric
+    lists that are not numeric, the layout of the flat tensor and the logged samples
+    are sent in one `gather_object` call.
+    """
+    layout = []
+    flat = []
+    objects = {}
+    for task_idx, task_output in enumerate(eval_tasks):
+        for key, values in task_output.sample_metrics.items():
+            kind = _metric_kind(values)
+            if kind is None:
+                objects[(task_idx, key)] = values
+            else:
+                layout.append((task_idx, key, len(values), kind))
+                flat.extend(float(v) for v in values)
+    payload = {
+        "layout": layout,
+        "objects": objects,
+        "samples": [task_output.logged_samples for task_output in eval_tasks]
+        if log_samples
+        else None,
+    }
+
+    local = torch.tensor(flat, dtype=torch.float64, device=device)
+    lengths = [torch.zeros(1, dtype=torch.long, device=device) for _ in range(world_size)]
+    torch.distributed.all_gather(
+        lengths, torch.tensor([len(flat)], dtype=torch.long, device=device)
+    )
+    lengths = [int(length.item()) for length in lengths]
+    padded = torch.zeros(max(max(lengths), 1), dtype=torch.float64, device=device)
+    padded[: len(flat)] = local
+    flat_list = [torch.zeros_like(padded) for _ in range(world_size)]
+    torch.distributed.all_gather(flat_list, padded)
+
+    payloads = [None] * world_size if rank == 0 else None
+    torch.distributed.gather_object(obj=payload, object_gather_list=payloads, dst=0)
+    if rank != 0:
+        return
+
+    casts = {"bool": bool, "int": int, "float": float}
+    gathered = [defaultdict(list) for _ in eval_tasks]
+    for rank_payload, rank_flat, length in zip(payloads, flat_list, lengths):
+        # keys are merged in rank order, as the per-key object gathers did
+        values = rank_flat[:length].tolist()
+        offset = 0
+        for task_idx, key, n, kind in rank_payload["layout"]:
+            cast = casts[kind]
+            gathered[task_idx][key].extend(cast(v) for v in values[offset : offset + n])
+            offset += n
+        for (task_idx, key), objs in rank_payload["objects"].items():
+            gathered[task_idx][key].extend(objs)
+
+    for task_idx, task_output in enumerate(eval_tasks):
+        for key, values in gathered[task_idx].items():
+            task_output.sample_metrics[key] = values
+        if log_samples:
+            task_output.logged_samples = list(
+                itertools.chain.from_iterable(
+                    rank_payload["samples"][task_idx] for rank_payload in payloads
+                )
+            )
+
+
+def score_doc(task_output, doc_id: int, doc, requests, filter_key: str, log_samples: bool) -> dict:
+    """Computes the metrics of one doc from its filtered responses and records them."""
+    task = task_output.task
+    metrics = task.process_results(
+        doc, [req.filtered_resps[filter_key] for req in requests]
+    )
+    if log_samples:
+        target = task.doc_to_target(doc)
+        example = {
+            "doc_id": doc_id,
+            "doc": doc,
+            "target": target,
+            "arguments": [req.args for req in requests],
+            "resps": [req.resps for req in requests],
+            "filtered_resps": [
+                req.filtered_resps[filter_key] for req in requests
+            ],
+            "doc_hash": hash_string(
+                json.dumps(
+                    requests[0].doc,
+                    indent=2,
+                    default=handle_non_serializable,
+                    ensure_ascii=False,
+                )
+            ),
+            "prompt_hash": hash_string(requests[0].arguments[0]),
+            "target_hash": hash_string(str(target)),
+        }
+        example.update(metrics)
+        task_output.logged_samples.append(example)
+    for metric, value in metrics.items():
+        task_output.sample_metrics[(metric, filter_key)].append(value)
+    return metrics
+
+
+def dedupe_requests(reqtype: str, reqs):
+    """
+    Creates `K` copies of each request `req` based off `K = req.repeats`.
+    Deterministic requests with the same arguments (e.g. repeats of a greedy
+    generation, or the unconditional requests of `acc_mutual_info`) are run only
+    once. Returns the copies, the requests to run and, for each copy, the index of
+    the request whose response it gets.
+    """
+    cloned_reqs = []
+    unique_reqs = []
+    slots = []
+    slot_by_key = {}
+    for req in reqs:
+        key = _request_key(reqtype, req)
+        for _ in range(req.repeats):
+            if key is None or key not in slot_by_key:
+                if key is not None:
+                    slot_by_key[key] = len(unique_reqs)
+                slots.append(len(unique_reqs))
+                unique_reqs.append(req)
+            else:
+                slots.append(slot_by_key[key])
+            cloned_reqs.append(req)
+    return cloned_reqs, unique_reqs, slots
+
+
+def sentinel_requests(reqtype: str, reqs, cloned_reqs, unique_reqs, padding: int) -> List[Instance]:
+    """
+    Near-free requests to run after `unique_reqs`, so that every rank runs the same
+    number of requests; their responses are dropped. Deduplicated copies are
+    replaced by sentinels, since other ranks may have fewer duplicates, and the
+    `padding` requests this rank has fewer than the others are added with their repeats.
+    """
+    num_sentinels = (len(cloned_reqs) - len(unique_reqs)) + padding * (
+        reqs[-1].repeats if reqs else 1
+    )
+    return [
+        Instance(
+            request_type=reqtype,
+            doc={},
+            arguments=SENTINEL_ARGUMENTS[reqtype],
+            idx=0,
+            metadata=(None, None, 1),
+        )
+        for _ in range(num_sentinels)
+    ]
+
+
+def attach_token_caches(lm, eval_tasks) -> None:
+    """Lets `lm` reuse the token ids of requests tokenized in previous runs, if it supports it."""
+    if hasattr(lm, "attach_token_cache"):
+        lm.attach_token_cache(
+            {
+                task_output.task_name: f"{task_output.task_name}-{task_output.task.config_hash()}"
+                for task_output in eval_tasks
+            }
+        )
+
+
+def save_token_caches(lm) -> None:
+    """Persists the token ids tokenized since `attach_token_caches`, if `lm` caches them."""
+    if hasattr(lm, "save_token_caches"):
+        lm.save_token_caches()
+
+
+def evaluate_streaming(
+    lm: "LM",
+    eval_tasks,
+    task_dict,
+    limit: Optional[int] = None,
+    bootstrap_iters: Optional[int] = 100000,
+    log_samples: bool = True,
+    verbosity: str = "INFO",
+    chunk_size: int = 256,
+    queue_size: int = 2,
+    on_outcome: Optional[Callable[[str, int, str, dict], None]] = None,
+):
+    """Evaluates a model on tasks as a pipeline over chunks of docs.
+
+    A background thread builds the requests of the next chunks of docs, the model
+    runs the requests of the current chunk, and another thread filters and scores
+    the previous chunk. At most `queue_size` chunks wait between stages, and the
+    Instances of a chunk are dropped once it is scored, so memory does not grow
+    with the number of docs (apart from per-doc metrics and logged samples).
+
+    :param on_outcome: Callable, optional
+        Called with (task_name, doc_id, filter_key, metrics) as soon as a doc is
+        scored, while later docs are still being evaluated.
+    :return
+        Dictionary of results, as returned by `evaluate`
+    """
+    eval_logger.setLevel(getattr(logging, f"{verbosity}"))
+    if lm.world_size > 1:
+        raise ValueError("Streaming evaluation only supports a single process.")
+    attach_token_caches(lm, eval_tasks)
+
+    def doc_chunks(task):
+        task_limit = get_sample_size(task, limit)
+        task.set_eval_limit(task_limit)
+        doc_iterator = task.doc_iterator(rank=0, limit=task_limit, world_size=1)
+        while True:
+            chunk = list(itertools.islice(doc_iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    for task_output in eval_tasks:
+        task = task_output.task
+        eval_logger.info(f"Streaming {task_output.task_name}")
+
+        def build(chunk):
+            return [
+                (doc_id, doc, task._build_doc_requests(doc_id, doc))
+                for doc_id, doc in chunk
+            ]
+
+        def score(built):
+            instances = [inst for _, _, doc_instances in built for inst in doc_instances]
+            for f in getattr(task, "_filters", []):
+                f.apply(instances)
+            for doc_id, doc, doc_instances in built:
+                doc_instances = sorted(doc_instances, key=lambda x: x.idx)
+                for filter_key in doc_instances[0].filtered_resps.keys():
+                    metrics = score_doc(
+                        task_output, doc_id, doc, doc_instances, filter_key, log_samples
+                    )
+                    if on_outcome is not None:
+                        on_outcome(task_output.task_name, doc_id, filter_key, metrics)
+
+        with ThreadPoolExecutor(max_workers=1) as scorer:
+            pending = deque()
+            for built in BatchPrefetcher(doc_chunks(task), build, depth=queue_size):
+                requests = defaultdict(list)
+                for _, _, doc_instances in built:
+                    for inst in doc_instances:
+                        requests[inst.request_type].append(inst)
+                for reqtype, reqs in requests.items():
+                    cloned_reqs, unique_reqs, slots = dedupe_requests(reqtype, reqs)
+                    resps = getattr(lm, reqtype)(unique_reqs)
+                    for slot, req in zip(slots, cloned_reqs):
+                        req.resps.append(resps[slot])
+
+                pending.append(scorer.submit(score, built))
+                while len(pending) > queue_size:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        save_token_caches(lm)
+
+    return aggregate_results(eval_tasks, task_dict, limit, bootstrap_iters, log_samples)
+
+
 def evaluate(
     lm: "LM",
     requests,
@@ -63,29 +348,34 @@ def evaluate(
     """
 
     eval_logger.setLevel(getattr(logging, f"{verbosity}"))
+    attach_token_caches(lm, eval_tasks)
 
     ### Run LM on inputs, get all outputs ###
     # execute each type of request
     for reqtype, reqs in requests.items():
         eval_logger.info(f"Running {reqtype} requests")
-        # create `K` copies of each request `req` based off `K = req.repeats`
-        cloned_reqs = []
-        for req in reqs:
-            cloned_reqs.extend([req] * req.repeats)
+        cloned_reqs, unique_reqs, slots = dedupe_requests(reqtype, reqs)
+        if len(unique_reqs) < len(cloned_reqs):
+            eval_logger.info(
+                f"Running {len(unique_reqs)} unique of {len(cloned_reqs)} {reqtype} requests"
+            )
 
-        if (lm.world_size > 1) and (padding_requests[reqtype] > 0):
-            for _ in range(padding_requests[reqtype]):
-                cloned_reqs.extend([req] * req.repeats)
+        sentinels = (
+            sentinel_requests(reqtype, reqs, cloned_reqs, unique_reqs, padding_requests[reqtype])
+            if lm.world_size > 1
+            else []
+        )
 
         # run requests through model
-        resps = getattr(lm, reqtype)(cloned_reqs)
+        resps = getattr(lm, reqtype)(unique_reqs + sentinels)[: len(unique_reqs)]
 
         # put responses from model into a list of length K for each request.
-        for x, req in zip(resps, cloned_reqs):
-            req.resps.append(x)
+        for slot, req in zip(slots, cloned_reqs):
+            req.resps.append(resps[slot])
 
         if lm.world_size > 1:
             lm.accelerator.wait_for_everyone()
+    save_token_caches(lm)
 
     RANK = lm.rank
     WORLD_SIZE = lm.world_size
@@ -111,142 +401,92 @@ def evaluate(
                 rank=RANK, limit=limit, world_size=WORLD_SIZE
             )
             for doc_id, doc in doc_iterator:
-                requests = instances_by_doc_id[doc_id]
-                metrics = task.process_results(
-                    doc, [req.filtered_resps[filter_key] for req in requests]
+                score_doc(
+                    task_output, doc_id, doc, instances_by_doc_id[doc_id], filter_key, log_samples
                 )
-                if log_samples:
-                    target = task.doc_to_target(doc)
-                    example = {
-                        "doc_id": doc_id,
-                        "doc": doc,
-                        "target": target,
-                        "arguments": [req.args for req in requests],
-                        "resps": [req.resps for req in requests],
-                        "filtered_resps": [
-                            req.filtered_resps[filter_key] for req in requests
-                        ],
-                        "doc_hash": hash_string(
-                            json.dumps(
-                                requests[0].doc,
-                                indent=2,
-                                default=handle_non_serializable,
-                                ensure_ascii=False,
-                            )
-                        ),
-                        "prompt_hash": hash_string(requests[0].arguments[0]),
-                        "target_hash": hash_string(str(target)),
-                    }
-                    example.update(metrics)
-                    task_output.logged_samples.append(example)
-                for metric, value in metrics.items():
-                    task_output.sample_metrics[(metric, filter_key)].append(value)
 
     if WORLD_SIZE > 1:
-        # if multigpu, then gather data across all ranks to rank 0
-        # first gather logged samples across all ranks
-        for task_output in eval_tasks:
-            if log_samples:
-                # for task_name, task_samples in list(samples.items()):
-                full_samples = [None] * WORLD_SIZE if RANK == 0 else None
-                torch.distributed.gather_object(
-                    obj=task_output.logged_samples,
-                    object_gather_list=full_samples,
-                    dst=0,
-                )
+        # if multigpu, then gather metrics and logged samples across all ranks to rank 0
+        gather_task_outputs(eval_tasks, RANK, WORLD_SIZE, lm.device, log_samples)
 
-                if RANK == 0:
-                    task_output.logged_samples = list(
-                        itertools.chain.from_iterable(full_samples)
-                    )
+    if RANK == 0:
+        return aggregate_results(eval_tasks, task_dict, limit, bootstrap_iters, log_samples)
+    else:
+        return None
 
-            # then collect metrics across all ranks
-            for metrics in task_output.sample_metrics:
-                metric_list = [None] * WORLD_SIZE if RANK == 0 else None
-                torch.distributed.gather_object(
-                    obj=task_output.sample_metrics[metrics],
-                    object_gather_list=metric_list,
-                    dst=0,
-                )
-                if RANK == 0:
-                    task_output.sample_metrics[metrics] = list(
-                        itertools.chain.from_iterable(metric_list)
-                    )
 
-    if RANK == 0:
-        ### Aggregate results over all datapoints ###
-        # aggregate results ; run bootstrap CIs
-        for task_output in eval_tasks:
-            task_output.calculate_aggregate_metric(bootstrap_iters=bootstrap_iters)
-        (
-            results,
-            samples,
-            configs,
-            versions,
-            num_fewshot,
-            higher_is_better,
-        ) = consolidate_results(eval_tasks)
-
-        ### Calculate group metrics ###
-        if bool(results):
-            results, versions, show_group_table, *_ = consolidate_group_results(
-                results, versions, task_dict
-            )
+def aggregate_results(eval_tasks, task_dict, limit, bootstrap_iters, log_samples: bool) -> dict:
+    """Aggregates the per-sample metrics of all tasks into the results dict."""
+    ### Aggregate results over all datapoints ###
+    # aggregate results ; run bootstrap CIs
+    for task_output in eval_tasks:
+        task_output.calculate_aggregate_metric(bootstrap_iters=bootstrap_iters)
+    (
+        results,
+        samples,
+        configs,
+        versions,
+        num_fewshot,
+        higher_is_better,
+    ) = consolidate_results(eval_tasks)
 
-        results_agg, group_agg = prepare_print_tasks(task_dict, results)
-        subtask_list = get_subtask_list(task_dict)
-
-        # collect all higher_is_better values for metrics
-        # in the group's subtasks.
-        # TODO: clean this up ; unify with the below metric_list loop?
-        _higher_is_better = {}
-        for group, task_list in subtask_list.items():
-            if (
-                len(task_list) != 0
-            ):  # subtask list will list "task_name": [] for solo tasks
-                for task in task_list:
-                    for m, h in higher_is_better[task].items():
-                        if m not in _higher_is_better.keys():
-                            _higher_is_better[m] = h
-
-                        if (
-                            m in _higher_is_better
-                            and _higher_is_better[m] is not None
-                            and _higher_is_better[m] != h
-                        ):
-                            eval_logger.warning(
-                                f"Higher_is_better values for metric {m} in group {group} are not consistent. Defaulting to None."
-                            )
-                            _higher_is_better[m] = None
-                higher_is_better[group] = _higher_is_better
-
-        results_dict = {
-            "results": dict(results_agg.items()),
-            **(
-                {"groups": dict(group_agg.items())}
-                if (bool(group_agg) & show_group_table)
-                else {}
-            ),
-            "group_subtasks": dict(reversed(subtask_list.items())),
-            "configs": dict(sorted(configs.items())),
-            "versions": dict(sorted(versions.items())),
-            "n-shot": dict(sorted(num_fewshot.items())),
-            "higher_is_better": dict(sorted(higher_is_better.items())),
-            "n-samples": {
-                task_output.task_name: {
-                    "original": len(task_output.task.eval_docs),
-                    "effective": min(
-                        limit if limit else len(task_output.task.eval_docs),
-                        len(task_output.task.eval_docs),
-                    ),
-                }
-                for task_output in eval_tasks
-            },
-        }
-        if log_samples:
-            results_dict["samples"] = dict(samples)
+    ### Calculate group metrics ###
+    if bool(results):
+        results, versions, show_group_table, *_ = consolidate_group_results(
+            results, versions, task_dict
+        )
 
-        return results_dict
+    results_agg, group_agg = prepare_print_tasks(task_dict, results)
+    subtask_list = get_subtask_list(task_dict)
 
-    else:
-        return None
+    # collect all higher_is_better values for metrics
+    # in the group's subtasks.
+    # TODO: clean this up ; unify with the below metric_list loop?
+    _higher_is_better = {}
+    for group, task_list in subtask_list.items():
+        if (
+            len(task_list) != 0
+        ):  # subtask list will list "task_name": [] for solo tasks
+            for task in task_list:
+                for m, h in higher_is_better[task].items():
+                    if m not in _higher_is_better.keys():
+                        _higher_is_better[m] = h
+
+                    if (
+                        m in _higher_is_better
+                        and _higher_is_better[m] is not None
+                        and _higher_is_better[m] != h
+                    ):
+                        eval_logger.warning(
+                            f"Higher_is_better values for metric {m} in group {group} are not consistent. Defaulting to None."
+                        )
+                        _higher_is_better[m] = None
+            higher_is_better[group] = _higher_is_better
+
+    results_dict = {
+        "results": dict(results_agg.items()),
+        **(
+            {"groups": dict(group_agg.items())}
+            if (bool(group_agg) & show_group_table)
+            else {}
+        ),
+        "group_subtasks": dict(reversed(subtask_list.items())),
+        "configs": dict(sorted(configs.items())),
+        "versions": dict(sorted(versions.items())),
+        "n-shot": dict(sorted(num_fewshot.items())),
+        "higher_is_better": dict(sorted(higher_is_better.items())),
+        "n-samples": {
+            task_output.task_name: {
+                "original": task_output.task.num_eval_docs(),
+                "effective": min(
+                    get_sample_size(task_output.task, limit) or task_output.task.num_eval_docs(),
+                    task_output.task.num_eval_docs(),
+                ),
+            }
+            for task_output in eval_tasks
+        },
+    }
+    if log_samples:
+        results_dict["samples"] = dict(samples)
+
+    return results_dict
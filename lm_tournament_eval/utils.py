@@ -2,6 +2,7 @@ import collections
 import fnmatch
 import functools
 import hashlib
+import heapq
 import importlib.util
 import inspect
 import json
@@ -10,7 +11,7 @@ import os
 import re
 from dataclasses import asdict, is_dataclass
 from itertools import islice
-from typing import Any, Callable, List
+from typing import Any, Callable, List, Optional
 
 import numpy as np
 import yaml
@@ -420,17 +421,34 @@ def import_function(loader, node):
     return function
 
 
-def load_yaml_config(yaml_path=None, yaml_config=None, yaml_dir=None, mode="full"):
-    if mode == "simple":
-        constructor_fn = ignore_constructor
-    elif mode == "full":
-        constructor_fn = import_function
+# `!function` tags are ignored when only indexing tasks, so the C-accelerated
+# loader can be used; `import_function` needs the file name of the Python loader
+class _SimpleYamlLoader(getattr(yaml, "CFullLoader", yaml.FullLoader)):
+    pass
 
-    # Add the import_function constructor to the YAML loader
-    yaml.add_constructor("!function", constructor_fn)
+
+_SimpleYamlLoader.add_constructor("!function", ignore_constructor)
+
+
+def load_yaml_config(
+    yaml_path=None,
+    yaml_config=None,
+    yaml_dir=None,
+    mode="full",
+    included_paths: Optional[List[str]] = None,
+):
+    """
+    Loads a task config and the configs it includes. The paths of all included
+    files are appended to `included_paths` if given.
+    """
     if yaml_config is None:
         with open(yaml_path, "rb") as file:
-            yaml_config = yaml.full_load(file)
+            if mode == "simple":
+                yaml_config = yaml.load(file, Loader=_SimpleYamlLoader)
+            else:
+                # Add the import_function constructor to the YAML loader
+                yaml.add_constructor("!function", import_function)
+                yaml_config = yaml.full_load(file)
 
     if yaml_dir is None:
         yaml_dir = os.path.dirname(yaml_path)
@@ -453,9 +471,13 @@ def load_yaml_config(yaml_path=None, yaml_config=None, yaml_dir=None, mode="full
             # is in the same dir as the original yaml
             if not os.path.isfile(path):
                 path = os.path.join(yaml_dir, path)
+            if included_paths is not None:
+                included_paths.append(path)
 
             try:
-                included_yaml_config = load_yaml_config(yaml_path=path, mode=mode)
+                included_yaml_config = load_yaml_config(
+                    yaml_path=path, mode=mode, included_paths=included_paths
+                )
                 final_yaml_config.update(included_yaml_config)
             except Exception as ex:
                 # If failed to load, ignore
@@ -475,11 +497,41 @@ env = Environment(loader=BaseLoader, undefined=StrictUndefined)
 env.filters["regex_replace"] = regex_replace
 
 
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str):
+    """Compiles a Jinja template once per template string."""
+    return env.from_string(template)
+
+
 def apply_template(template: str, doc: dict) -> str:
-    rtemplate = env.from_string(template)
+    rtemplate = compile_template(template)
     return rtemplate.render(**doc)
 
 
+def apply_template_batch(template: str, docs: List[dict]) -> List[str]:
+    """Renders `template` for every doc in `docs` with a single compiled template."""
+    rtemplate = compile_template(template)
+    return [rtemplate.render(**doc) for doc in docs]
+
+
+class TemplateRenderer:
+    """
+    Renders a template into a new column of a batched `datasets.Dataset.map`, e.g.
+    `dataset.map(TemplateRenderer(template, "prompt"), batched=True, num_proc=8)`.
+    Only the template string is pickled, each worker compiles it once.
+    """
+
+    def __init__(self, template: str, column: str) -> None:
+        self.template = template
+        self.column = column
+
+    def __call__(self, batch: dict) -> dict:
+        keys = list(batch.keys())
+        num_rows = len(batch[keys[0]]) if keys else 0
+        docs = [{key: batch[key][i] for key in keys} for i in range(num_rows)]
+        return {self.column: apply_template_batch(self.template, docs)}
+
+
 def create_iterator(raw_iterator, *, rank=0, world_size=1, limit=None):
     """
     Method for creating a (potentially) sliced and limited
@@ -487,3 +539,19 @@ def create_iterator(raw_iterator, *, rank=0, world_size=1, limit=None):
     among ranks in multigpu setting or only pulling a sample of documents
     """
     return islice(raw_iterator, rank, limit, world_size)
+
+
+def plan_balanced_shards(costs: List[float], world_size: int) -> List[List[int]]:
+    """
+    Splits documents among ranks so that every rank gets about the same total cost
+    (longest processing time first: the most expensive remaining document goes to
+    the least loaded rank). Returns the sorted document indices of each rank. The
+    plan is deterministic, so every rank computes the same one.
+    """
+    shards = [[] for _ in range(world_size)]
+    loads = [(0.0, rank) for rank in range(world_size)]
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, rank = heapq.heappop(loads)
+        shards[rank].append(i)
+        heapq.heappush(loads, (load + costs[i], rank))
+    return [sorted(shard) for shard in shards]
@@ -0,0 +1,12 @@
+import pytest
+
+from lm_tournament_eval.caching import cache
+from lm_tournament_eval.caching.cache import CacheStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """An unbounded cache store in a temporary directory, used by all cache helpers."""
+    store = CacheStore(str(tmp_path), max_bytes=None)
+    monkeypatch.setattr(cache, "_store", store)
+    return store
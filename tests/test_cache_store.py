@@ -0,0 +1,72 @@
+import os
+import time
+
+import pytest
+
+from lm_tournament_eval.caching import cache
+from lm_tournament_eval.caching.cache import CacheStore
+
+
+def _write(store, key, nbytes):
+    with store.writer(key) as file:
+        file.write(b"x" * nbytes)
+
+
+def _keys(store):
+    return [key for key, _, _ in store.entries()]
+
+
+def test_writer_replaces_entries(store):
+    _write(store, "a", 10)
+    _write(store, "a", 3)
+    with store.open("a") as file:
+        assert file.read() == b"xxx"
+    assert store.entries()[0][:2] == ("a", 3)
+    with store.open("missing") as file:
+        assert file is None
+
+
+def test_failed_write_keeps_previous_entry(store):
+    _write(store, "a", 4)
+    with pytest.raises(RuntimeError):
+        with store.writer("a") as file:
+            file.write(b"partial")
+            raise RuntimeError
+    with store.open("a") as file:
+        assert file.read() == b"xxxx"
+    leftovers = [f for _, _, files in os.walk(store.root) for f in files if f.endswith(".tmp")]
+    assert leftovers == []
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    store = CacheStore(str(tmp_path), max_bytes=250)
+    for key in ("a", "b", "c"):
+        _write(store, key, 100)
+        time.sleep(0.01)
+    # "a" was evicted to stay within the budget
+    assert sorted(_keys(store)) == ["b", "c"]
+
+    # reading "b" makes "c" the least recently used entry
+    with store.open("b"):
+        pass
+    time.sleep(0.01)
+    _write(store, "d", 100)
+    assert sorted(_keys(store)) == ["b", "d"]
+    assert not os.path.exists(store.path("c"))
+
+
+def test_prune_by_age_and_prefix(store):
+    _write(store, "requests-a", 1)
+    _write(store, "tokens-a", 1)
+    assert store.prune(older_than=-1, prefix="requests-") == ["requests-a"]
+    assert _keys(store) == ["tokens-a"]
+
+
+def test_delete_cache_only_deletes_requests(store):
+    cache.save_requests_to_cache("requests-a", [(0, [(0, "loglikelihood", ["", " a"])])])
+    cache.save_to_cache("requests-b", [1, 2])
+    _write(store, "task_index-x", 2)
+    _write(store, "tokens-x", 2)
+
+    cache.delete_cache()
+    assert sorted(_keys(store)) == ["task_index-x", "tokens-x"]
@@ -0,0 +1,64 @@
+from lm_tournament_eval.api.instance import Instance
+from lm_tournament_eval.tournament_evaluator import dedupe_requests
+
+
+def _request(reqtype, arguments, doc_id, repeats=1):
+    return Instance(
+        request_type=reqtype,
+        doc={},
+        arguments=arguments,
+        idx=0,
+        metadata=("task", doc_id, repeats),
+    )
+
+
+def _fan_out(reqtype, reqs):
+    cloned_reqs, unique_reqs, slots = dedupe_requests(reqtype, reqs)
+    # stand-in responses that identify the request they were computed for
+    resps = [req.arguments for req in unique_reqs]
+    for slot, req in zip(slots, cloned_reqs):
+        req.resps.append(resps[slot])
+    return cloned_reqs, unique_reqs, slots
+
+
+def test_identical_loglikelihood_requests_run_once():
+    reqs = [
+        _request("loglikelihood", ("", " yes"), 0),
+        _request("loglikelihood", ("ctx", " yes"), 1),
+        _request("loglikelihood", ("", " yes"), 2),
+        _request("loglikelihood", ("ctx", " no"), 3),
+    ]
+    cloned_reqs, unique_reqs, slots = _fan_out("loglikelihood", reqs)
+
+    assert [req.arguments for req in unique_reqs] == [("", " yes"), ("ctx", " yes"), ("ctx", " no")]
+    assert slots == [0, 1, 0, 2]
+    assert cloned_reqs == reqs
+    for req in reqs:
+        assert req.resps == [req.arguments]
+
+
+def test_greedy_repeats_run_once():
+    gen_kwargs = {"until": ["\n"], "do_sample": False}
+    req = _request("generate_until", ("Q:", gen_kwargs), 0, repeats=4)
+    cloned_reqs, unique_reqs, slots = _fan_out("generate_until", [req])
+
+    assert len(cloned_reqs) == 4
+    assert unique_reqs == [req]
+    assert slots == [0, 0, 0, 0]
+    assert req.resps == [("Q:", gen_kwargs)] * 4
+
+
+def test_sampled_requests_are_not_deduplicated():
+    sampled = {"until": ["\n"], "do_sample": True}
+    with_temperature = {"until": ["\n"], "temperature": 0.7}
+    reqs = [
+        _request("generate_until", ("Q:", sampled), 0, repeats=2),
+        _request("generate_until", ("Q:", sampled), 1),
+        _request("generate_until", ("Q:", with_temperature), 2),
+        _request("generate_until", ("Q:", with_temperature), 3),
+    ]
+    cloned_reqs, unique_reqs, slots = _fan_out("generate_until", reqs)
+
+    assert len(unique_reqs) == len(cloned_reqs) == 5
+    assert slots == [0, 1, 2, 3, 4]
+    assert [len(req.resps) for req in reqs] == [2, 1, 1, 1]
@@ -0,0 +1,46 @@
+import pytest
+
+from lm_tournament_eval.caching import cache
+
+
+pytestmark = pytest.mark.usefixtures("store")
+
+
+def _doc_requests(num_docs):
+    return [
+        (doc_id, [(idx, "loglikelihood", [f"q{doc_id}", f" choice {idx}"]) for idx in range(2)])
+        for doc_id in range(num_docs)
+    ]
+
+
+def test_round_trip():
+    doc_requests = _doc_requests(5)
+    cache.save_requests_to_cache("requests-a", doc_requests)
+
+    assert cache.requests_cache_exists("requests-a")
+    assert cache.load_requests_from_cache("requests-a") == doc_requests
+
+
+def test_docs_are_sorted_by_doc_id():
+    doc_requests = _doc_requests(4)
+    cache.save_requests_to_cache("requests-a", list(reversed(doc_requests)))
+    assert cache.load_requests_from_cache("requests-a") == doc_requests
+
+
+def test_loads_only_a_prefix():
+    doc_requests = _doc_requests(5)
+    cache.save_requests_to_cache("requests-a", doc_requests)
+
+    assert cache.load_requests_from_cache("requests-a", max_doc_id=2) == doc_requests[:2]
+    assert cache.load_requests_from_cache("requests-a", max_doc_id=0) == []
+    assert cache.load_requests_from_cache("requests-a", max_doc_id=10) == doc_requests
+
+
+def test_missing_entry():
+    assert not cache.requests_cache_exists("requests-missing")
+    assert cache.load_requests_from_cache("requests-missing") is None
+
+
+def test_unserializable_arguments_are_not_cached():
+    cache.save_requests_to_cache("requests-a", [(0, [(0, "loglikelihood", [object()])])])
+    assert not cache.requests_cache_exists("requests-a")
@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from lm_tournament_eval.api.instance import Instance
+from lm_tournament_eval.tournament_evaluator import (
+    SENTINEL_ARGUMENTS,
+    dedupe_requests,
+    sentinel_requests,
+)
+from lm_tournament_eval.utils import plan_balanced_shards
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 3, 8])
+def test_plan_balanced_shards_partitions_docs(world_size):
+    rnd = random.Random(world_size)
+    costs = [rnd.uniform(1, 100) for _ in range(101)]
+    shards = plan_balanced_shards(costs, world_size)
+
+    assert len(shards) == world_size
+    assert sorted(i for shard in shards for i in shard) == list(range(len(costs)))
+    assert all(shard == sorted(shard) for shard in shards)
+
+
+def test_plan_balanced_shards_balances_cost():
+    rnd = random.Random(0)
+    costs = [rnd.uniform(1, 100) for _ in range(200)]
+    loads = [sum(costs[i] for i in shard) for shard in plan_balanced_shards(costs, 4)]
+
+    # longest processing time first is never off by more than the largest cost
+    assert max(loads) - min(loads) <= max(costs)
+
+
+def test_plan_balanced_shards_is_deterministic():
+    costs = [3.0, 1.0, 3.0, 2.0, 2.0, 1.0, 3.0]
+    assert plan_balanced_shards(costs, 3) == plan_balanced_shards(list(costs), 3)
+
+
+def test_plan_balanced_shards_more_ranks_than_docs():
+    shards = plan_balanced_shards([1.0, 2.0], 4)
+    assert sorted(map(len, shards)) == [0, 0, 1, 1]
+
+
+def _requests(num_docs, duplicates, reqtype="loglikelihood"):
+    # `duplicates` docs share their arguments with doc 0
+    return [
+        Instance(
+            request_type=reqtype,
+            doc={},
+            arguments=("context 0" if doc_id < duplicates else f"context {doc_id}", " answer"),
+            idx=0,
+            metadata=("task", doc_id, 1),
+        )
+        for doc_id in range(num_docs)
+    ]
+
+
+def test_sentinel_padding_evens_out_ranks():
+    # ranks with different numbers of requests and of duplicates among them
+    ranks = [_requests(10, 4), _requests(7, 1), _requests(9, 0)]
+    # as computed by create_requests from the gathered request counts
+    padding = [max(map(len, ranks)) - len(reqs) for reqs in ranks]
+
+    num_run = []
+    for reqs, pad in zip(ranks, padding):
+        cloned_reqs, unique_reqs, _ = dedupe_requests("loglikelihood", reqs)
+        sentinels = sentinel_requests("loglikelihood", reqs, cloned_reqs, unique_reqs, pad)
+        assert all(s.doc_id is None for s in sentinels)
+        num_run.append(len(unique_reqs) + len(sentinels))
+
+    assert num_run == [10, 10, 10]
+
+
+def test_sentinel_padding_with_repeats():
+    ranks = []
+    for num_docs in (5, 3):
+        reqs = _requests(num_docs, 0, reqtype="generate_until")
+        for req in reqs:
+            req.arguments = (req.arguments[0], {"do_sample": True})
+            req.repeats = 3
+        ranks.append(reqs)
+    padding = [max(map(len, ranks)) - len(reqs) for reqs in ranks]
+
+    num_run = []
+    for reqs, pad in zip(ranks, padding):
+        cloned_reqs, unique_reqs, _ = dedupe_requests("generate_until", reqs)
+        sentinels = sentinel_requests("generate_until", reqs, cloned_reqs, unique_reqs, pad)
+        num_run.append(len(unique_reqs) + len(sentinels))
+
+    assert num_run == [15, 15]
+
+
+@pytest.mark.parametrize("reqtype", sorted(SENTINEL_ARGUMENTS))
+def test_sentinel_text_is_not_whitespace(reqtype):
+    # whitespace-only text may encode to no tokens, which models reject
+    request_text = SENTINEL_ARGUMENTS[reqtype][0 if reqtype != "loglikelihood" else 1]
+    assert request_text.strip()
@@ -0,0 +1,69 @@
+import pytest
+
+from lm_tournament_eval.caching.token_cache import TokenCache
+
+
+pytestmark = pytest.mark.usefixtures("store")
+
+
+PAIRS = {
+    ("The capital of France is", " Paris"): ([10, 11, 12, 13], [14]),
+    ("", " hello"): ([0], [20, 21]),
+    ("2 + 2 =", " 4"): ([30, 31, 32], [33]),
+}
+
+
+def _add(token_cache, pairs):
+    for (context, continuation), (context_enc, continuation_enc) in pairs.items():
+        token_cache.add(token_cache.pair_hash(context, continuation), context_enc, continuation_enc)
+
+
+def _get(token_cache, context, continuation):
+    return token_cache.get(token_cache.pair_hash(context, continuation))
+
+
+def test_empty_cache():
+    token_cache = TokenCache("tokens-test")
+    assert _get(token_cache, "a", "b") is None
+    token_cache.save()
+    assert token_cache.hashes.shape == (0,)
+
+
+def test_added_pairs_are_found_before_and_after_save():
+    token_cache = TokenCache("tokens-test")
+    _add(token_cache, PAIRS)
+    for pair, encs in PAIRS.items():
+        assert _get(token_cache, *pair) == encs
+
+    token_cache.save()
+    assert token_cache.new_pairs == {}
+    for pair, encs in PAIRS.items():
+        assert _get(token_cache, *pair) == encs
+
+    reloaded = TokenCache("tokens-test")
+    for pair, encs in PAIRS.items():
+        assert _get(reloaded, *pair) == (list(encs[0]), list(encs[1]))
+
+
+def test_save_merges_pairs_saved_by_others():
+    first, second = TokenCache("tokens-test"), TokenCache("tokens-test")
+    pairs = list(PAIRS.items())
+    _add(first, dict(pairs[:2]))
+    _add(second, dict(pairs[1:]))
+
+    first.save()
+    # `second` was loaded before `first` saved, its save keeps the pairs of `first`
+    second.save()
+
+    reloaded = TokenCache("tokens-test")
+    assert len(reloaded.hashes) == len(PAIRS)
+    assert list(reloaded.hashes) == sorted(reloaded.hashes)
+    for pair, encs in PAIRS.items():
+        assert _get(reloaded, *pair) == encs
+
+
+def test_caches_are_separated_by_key():
+    token_cache = TokenCache("tokens-a")
+    _add(token_cache, PAIRS)
+    token_cache.save()
+    assert _get(TokenCache("tokens-b"), "2 + 2 =", " 4") is None